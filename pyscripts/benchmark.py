@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+import pandas as pd
+import numpy as np
+import os
+import time
+import shutil
+import tempfile
+import tracemalloc
+import subprocess
+
+from synthetic_data import SyntheticChamber
+
+class PipelineBenchmark:
+    """
+    Benchmark of the pipeline on synthetic chambers (see `SyntheticChamber`)
+    of different sizes. Each scale is generated in a temporary folder, the
+    stages are timed and memory-profiled, and the results are appended to
+    `../data/benchmarks/history.csv`, so the runs can be compared (see
+    `compare`).
+    """
+
+    modes = [('unknown', 'against', False),
+             ('strong', 'against', False),
+             ('partial', 'against', False),
+             ('partial-unknown', 'against', False),
+             ('same', 'same', False),
+             ('same', 'same', True)]
+
+    # Coded votes written by the generator (against, abstention, obstruction
+    # and for), which the incidence matrix must have.
+    votes = [-1, 0, 0.1, 1]
+
+    def __init__(self, results_folder = '../data/benchmarks/') -> None:
+        """
+        Init function. It creates the results folder.
+        - results_folder (str): folder of the results.
+        """
+        self.results_folder = os.path.abspath(results_folder)
+        if not os.path.exists(self.results_folder):
+            os.makedirs(self.results_folder)
+        self.history = os.path.join(self.results_folder, 'history.csv')
+
+    def measure(self, function, *args, **kwargs) -> tuple:
+        """
+        Run a function twice and measure it. The first run traces the peak of
+        memory allocated in this process (tracemalloc, which includes numpy
+        arrays) and the second one is timed, so the overhead of tracemalloc
+        is not counted as time. It returns the result of the second run and a
+        dict with the wall time, the CPU time (with the finished child
+        processes) and the peak memory.
+        """
+        tracemalloc.start()
+        function(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        start_times = os.times()
+        start = time.perf_counter()
+
+        result = function(*args, **kwargs)
+
+        wall = time.perf_counter() - start
+        end_times = os.times()
+        cpu = sum(end_times[:4]) - sum(start_times[:4])
+
+        return result, {'wall_time': wall, 'cpu_time': cpu, 'peak_memory': peak}
+
+    def run_scale(self, deputies, votings_per_year, year1 = 2019, year2 = 2021, density = 0.1, seed = 0) -> list:
+        """
+        Generate a synthetic chamber and measure `prepare_votes_table`,
+        `incidence_matrix`, `build_adjacency_matrix` in every mode and
+        `build_graph_threshold` (at the threshold that keeps the given density
+        of links) for the last legislature of the years.
+        - deputies (int), votings_per_year (int): size of the chamber.
+        - year1, year2 (int): years of the synthetic data.
+        - density (float): fraction of the links in the thresholded graph.
+        - seed (int): seed of the synthetic chamber.
+        """
+        from prepare_data import DataPreprocessing
+        from prepare_adjacency_matrix import GraphConstruction
+
+        root = tempfile.mkdtemp(prefix = 'benchmark-')
+        data_root = os.path.join(root, 'data')
+        # Unless a log is given, the records of the measured stages are not
+        # mixed with the ones of the pipeline.
+        log = os.environ.get('PIPELINE_LOG')
+        if log is None:
+            os.environ['PIPELINE_LOG'] = os.path.join(data_root, 'logs', 'pipeline.jsonl')
+
+        results = []
+        def record(stage, measures, rows, columns):
+            results.append(dict(stage = stage, deputies = deputies, votings_per_year = votings_per_year,
+                                rows = rows, columns = columns, **measures))
+
+        try:
+            chamber = SyntheticChamber(deputies = deputies, votings_per_year = votings_per_year, seed = seed)
+            chamber.write(year1, year2, data_root = data_root)
+
+            preprocessing = DataPreprocessing(data_root = data_root)
+            _, measures = self.measure(preprocessing.prepare_votes_table, year1, year2, verify = False)
+            with open(os.path.join(data_root, 'tables/votes_deputies.csv'), 'rb') as f:
+                rows = sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(2**20), b'')) - 1
+            record('prepare_votes_table', measures, rows, 3)
+
+            _, measures = self.measure(preprocessing.incidence_matrix, verify = False)
+            record('incidence_matrix', measures, rows, 3)
+
+            graphConstrutor = GraphConstruction(data_root = data_root)
+            legislature = int(chamber.legislature(year2, 12))
+            # In memory, so the reading of the file is not measured.
+            incidence_matrix = graphConstrutor.import_incidence_matrix(legislature).copy()
+
+            # Otherwise, the stages would be timed on a degenerate matrix.
+            values = np.unique(incidence_matrix.to_numpy(dtype = float))
+            missing = [value for value in self.votes if not np.isclose(values, value).any()]
+            if len(missing) > 0:
+                raise Exception('The incidence matrix has no votes {}. The votes were lost in the preparation.'.format(missing))
+
+            for abstention_decision, obstruction_decision, agreement in self.modes:
+                adjacency_matrix, measures = self.measure(graphConstrutor.build_adjacency_matrix, incidence_matrix,
+                                                          abstention_decision, obstruction_decision, agreement)
+                record('build_adjacency_matrix[{}, {}, {}]'.format(abstention_decision, obstruction_decision, agreement),
+                       measures, *incidence_matrix.shape)
+
+            weights = adjacency_matrix.to_numpy()[np.triu_indices(adjacency_matrix.shape[0], 1)]
+            threshold = float(np.quantile(weights, 1 - density))
+            _, measures = self.measure(graphConstrutor.build_graph_threshold, adjacency_matrix, threshold)
+            record('build_graph_threshold', measures, *adjacency_matrix.shape)
+
+        finally:
+            if log is None:
+                del os.environ['PIPELINE_LOG']
+            shutil.rmtree(root, ignore_errors = True)
+
+        return results
+
+    def run(self, scales, year1 = 2019, year2 = 2021, density = 0.1, seed = 0) -> pd.DataFrame:
+        """
+        Benchmark all the scales and append the results to the history, with
+        the time of the run and the current commit.
+        - scales (list): tuples (deputies, votings_per_year).
+        """
+        results = []
+        for deputies, votings_per_year in scales:
+            print('MESSAGE - Benchmarking {} deputies and {} votings per year.'.format(deputies, votings_per_year))
+            results += self.run_scale(deputies, votings_per_year, year1, year2, density, seed)
+
+        results = pd.DataFrame(results)
+        results.insert(0, 'run', pd.Timestamp.now().strftime('%Y-%m-%dT%H:%M:%S'))
+        results.insert(1, 'commit', self.commit())
+
+        if os.path.exists(self.history):
+            # The rows follow the columns of the history (the ones it does
+            # not have are left out).
+            results = results.reindex(columns = pd.read_csv(self.history, nrows = 0).columns)
+        results.to_csv(self.history, mode = 'a', header = not os.path.exists(self.history), index = False)
+        print('MESSAGE - The results were saved in {}.'.format(self.history))
+
+        return results
+
+    def commit(self) -> str:
+        """
+        Current git commit (empty when git is not available).
+        """
+        try:
+            return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True,
+                                  text = True, cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        except OSError:
+            return ''
+
+    def compare(self, tolerance = 1.25) -> pd.DataFrame:
+        """
+        Compare the last run with the previous run of each stage and scale.
+        It returns the ratios (last/previous) of time and memory and prints
+        the stages slower or larger than the tolerance.
+        - tolerance (float): ratio above which a stage is a regression.
+        """
+        history = pd.read_csv(self.history)
+        key = ['stage', 'deputies', 'votings_per_year']
+        measures = ['wall_time', 'cpu_time', 'peak_memory']
+
+        last = history[history.run == history.run.max()].set_index(key)
+        previous = history[history.run < history.run.max()].groupby(key).last()
+        ratios = (last[measures]/previous[measures].reindex(last.index)).dropna(how = 'all')
+
+        for (stage, deputies, votings_per_year), row in ratios.iterrows():
+            worse = row[row > tolerance]
+            if len(worse) > 0:
+                print('MESSAGE - Regression in {} ({} deputies, {} votings per year): {}.'.format(
+                      stage, deputies, votings_per_year, ', '.join('{} x{:.2f}'.format(m, r) for m, r in worse.items())))
+
+        return ratios
+
+if __name__ == '__main__':
+
+    print("INFO - You can change the scales of the benchmark in the script file!")
+
+    scales = [(513, 400), (1026, 800), (2052, 1600)]
+
+    benchmark = PipelineBenchmark()
+    print(benchmark.run(scales).to_string())
+    benchmark.compare()
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+import os
+
+from prepare_adjacency_matrix import GraphConstruction
+from network_metrics import NetworkMetrics
+from instrumentation import stage
+
+class CommunityDetection:
+    """
+    Class to detect communities with the Louvain method directly on the
+    weighted adjacency matrices of `GraphConstruction.build_adjacency_matrix`
+    (over CSR arrays, instead of networkx graphs). The partitions are cached
+    in `graphs/partitions/` of the data folder.
+    """
+
+    def __init__(self, data_root = '../data') -> None:
+        """
+        Init function. It creates all necessary folders.
+        - data_root (str): folder of the data (see `DataPreprocessing`).
+        """
+        self.data_root = data_root
+        self.graphConstrutor = GraphConstruction(data_root = data_root)
+        self.metrics = NetworkMetrics(data_root = data_root)
+        self.data_folder()
+
+    def data_folder(self) -> None:
+        """
+        Create the folder of the cached partitions.
+        """
+        if not os.path.exists(os.path.join(self.data_root, 'graphs/partitions')):
+            os.mkdir(os.path.join(self.data_root, 'graphs/partitions'))
+
+    def weighted_graph(self, adjacency_matrix, threshold = 0) -> sp.csr_matrix:
+        """
+        Sparse weighted graph with the weights of the adjacency matrix above
+        the threshold. Negative weights are always dropped, since the
+        modularity is not defined for them, and so is the diagonal (and the
+        links dropped from a `SparseMatrix`).
+        """
+        weights = adjacency_matrix.to_numpy(dtype = float).copy()
+        weights[~(weights > max(threshold, 0))] = 0
+        np.fill_diagonal(weights, 0)
+        return sp.csr_matrix(weights)
+
+    def local_moving(self, graph, resolution, rng) -> tuple:
+        """
+        Louvain local moving phase: each node (in random order) goes to the
+        community of its neighbors with the largest modularity gain, until
+        no node moves. It returns the communities (0, ..., k-1) and whether
+        some node moved.
+        """
+        n = graph.shape[0]
+        indptr, indices, data = graph.indptr, graph.indices, graph.data
+        degrees = np.asarray(graph.sum(axis = 1)).ravel()
+        total = degrees.sum()
+
+        labels = np.arange(n)
+        community_degree = degrees.copy()
+        improved = False
+        moved = True
+
+        while moved:
+            moved = False
+            for i in rng.permutation(n):
+                neighbors = indices[indptr[i]:indptr[i + 1]]
+                weights = data[indptr[i]:indptr[i + 1]]
+                other = neighbors != i
+                neighbors, weights = neighbors[other], weights[other]
+
+                current = labels[i]
+                community_degree[current] -= degrees[i]
+
+                candidates, position = np.unique(labels[neighbors], return_inverse = True)
+                links = np.bincount(position, weights = weights, minlength = len(candidates))
+                gains = links - resolution*community_degree[candidates]*degrees[i]/total
+
+                best = current
+                best_gain = links[candidates == current].sum() - resolution*community_degree[current]*degrees[i]/total
+                if len(candidates) > 0 and gains.max() > best_gain + 1e-12:
+                    best = candidates[gains.argmax()]
+                    moved = True
+                    improved = True
+
+                labels[i] = best
+                community_degree[best] += degrees[i]
+
+        return np.unique(labels, return_inverse = True)[1], improved
+
+    def aggregate(self, graph, labels) -> sp.csr_matrix:
+        """
+        Graph where each community is a node. The weights inside a community
+        become a self-loop.
+        """
+        n = graph.shape[0]
+        membership = sp.csr_matrix((np.ones(n), (np.arange(n), labels)), shape = (n, labels.max() + 1))
+        return (membership.T @ graph @ membership).tocsr()
+
+    def louvain(self, graph, resolution = 1, seed = 0) -> np.ndarray:
+        """
+        Louvain method: local moving and aggregation of the communities
+        until the modularity does not improve. It returns the community of
+        each node.
+        - graph (csr_matrix): symmetric non-negative weights.
+        - resolution (float): resolution of the modularity.
+        - seed (int): seed of the order of the nodes.
+        """
+        rng = np.random.default_rng(seed)
+        membership = np.arange(graph.shape[0])
+
+        while graph.nnz > 0:
+            labels, improved = self.local_moving(graph, resolution, rng)
+            if not improved:
+                break
+            membership = labels[membership]
+            graph = self.aggregate(graph, labels)
+
+        return membership
+
+    @stage()
+    def partition(self, legislature, abstention_decision, obstruction_decision, resolution = 1,
+                  threshold = 0, seed = 0, verify = True) -> pd.Series:
+        """
+        Communities of the deputies of a legislature (see `louvain`). The
+        result is cached by legislature, decisions, resolution, threshold
+        and seed, and it is computed again when the adjacency matrix changed
+        (see `ResultCache`).
+        - verify (bool): use the cached partition when it is fresh.
+        """
+        file_name = os.path.join(self.data_root, 'graphs/partitions/{}_{}_{}_{}_{}_{}.npz'.format(
+                                     legislature, abstention_decision, obstruction_decision, resolution, threshold, seed))
+        cache = self.graphConstrutor.cache
+        key = cache.key(self.graphConstrutor.adjacency_files(legislature, abstention_decision, obstruction_decision),
+                        {'resolution': resolution, 'threshold': threshold, 'seed': seed})
+        if verify and cache.fresh(file_name, key):
+            with np.load(file_name) as cached:
+                return pd.Series(cached['labels'], index = cached['deputies'], name = 'community')
+
+        adjacency_matrix = self.graphConstrutor.import_adjacency_matrix(legislature, abstention_decision, obstruction_decision)
+        labels = self.louvain(self.weighted_graph(adjacency_matrix, threshold), resolution, seed)
+
+        np.savez(file_name, deputies = np.asarray(adjacency_matrix.columns), labels = labels)
+        cache.store(file_name, key, [file_name], group = 'partitions')
+
+        return pd.Series(labels, index = adjacency_matrix.columns, name = 'community')
+
+    def resolution_sweep(self, legislature, abstention_decision, obstruction_decision, resolutions,
+                         threshold = 0, seed = 0, verify = True) -> pd.DataFrame:
+        """
+        Number of communities and modularity (at resolution 1) of the
+        partitions found with each resolution.
+        """
+        adjacency_matrix = self.graphConstrutor.import_adjacency_matrix(legislature, abstention_decision, obstruction_decision)
+        graph = self.weighted_graph(adjacency_matrix, threshold)
+
+        results = []
+        for resolution in resolutions:
+            labels = self.partition(legislature, abstention_decision, obstruction_decision, resolution,
+                                    threshold, seed, verify)
+            results.append((resolution, labels.nunique(), self.metrics.modularity(graph, labels.to_numpy())))
+
+        return pd.DataFrame(results, columns = ['resolution', 'communities', 'modularity']).set_index('resolution')
+
+    def attribute_modularity(self, legislature, abstention_decision, obstruction_decision, attributes = ('siglaPartido', 'siglaUf', 'region'),
+                             threshold = 0, resolution = 1) -> pd.Series:
+        """
+        Modularity of the partitions given by the deputies' attributes (party,
+        state and region, by default) on the weighted graph.
+        """
+        adjacency_matrix = self.graphConstrutor.import_adjacency_matrix(legislature, abstention_decision, obstruction_decision)
+        graph = self.weighted_graph(adjacency_matrix, threshold)
+
+        deputies = self.graphConstrutor.deputies_store()
+
+        return pd.Series({attribute: self.metrics.modularity(graph, deputies.labels(legislature, adjacency_matrix.columns, attribute),
+                                                             resolution)
+                          for attribute in attributes})
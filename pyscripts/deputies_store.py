@@ -0,0 +1,52 @@
+#!/usr/bin/python
+
+import pandas as pd
+import numpy as np
+import os
+
+class DeputiesStore:
+    """
+    The deputies' attributes (party, state, region and name) read once from
+    `deputies.csv` and indexed by (legislature, deputy id). The attributes are
+    categorical, so each one has integer codes shared by all legislatures.
+    """
+
+    attributes = ['siglaPartido', 'siglaUf', 'region', 'nome']
+
+    def __init__(self, file_name = None, data_root = '../data') -> None:
+        """
+        Load the deputies. When a deputy appears more than once in a
+        legislature, the last row is kept.
+        - file_name (str): deputies table (see `DataPreprocessing.get_deputies`).
+          The default is `tables/deputies.csv` in the data folder.
+        - data_root (str): folder of the data (see `DataPreprocessing`).
+        """
+        file_name = file_name if file_name is not None else os.path.join(data_root, 'tables/deputies.csv')
+        deputies = pd.read_csv(file_name, index_col = 0)
+        deputies['id'] = deputies.id.astype(int)
+        deputies = deputies.drop_duplicates(['idLegislatura', 'id'], keep = 'last')
+
+        self.deputies = deputies.set_index(['idLegislatura', 'id'])[self.attributes].astype('category').sort_index()
+
+    def categories(self, attribute) -> pd.Index:
+        """
+        Values of the attribute, in the order of its integer codes.
+        """
+        return self.deputies[attribute].cat.categories
+
+    def table(self, legislature, deputies) -> pd.DataFrame:
+        """
+        Attributes of the deputies of a legislature, in the given order (for
+        instance, the columns of an adjacency matrix). Unknown deputies have
+        NaN attributes.
+        """
+        table = self.deputies.xs(legislature, level = 'idLegislatura') if legislature in self.deputies.index.levels[0] \
+                else self.deputies.iloc[:0].droplevel('idLegislatura')
+        return table.reindex(pd.Index(deputies).astype(int))
+
+    def labels(self, legislature, deputies, attribute) -> np.ndarray:
+        """
+        Integer codes of the attribute of the deputies of a legislature, in
+        the given order. Unknown deputies have -1.
+        """
+        return self.table(legislature, deputies)[attribute].cat.codes.to_numpy(dtype = np.int64)
@@ -0,0 +1,269 @@
+#!/usr/bin/python
+
+import pandas as pd
+import os
+import time
+import json
+import functools
+import threading
+import resource
+import cProfile
+
+_local = threading.local()
+
+# Stages running in this process (in any thread).
+_active = []
+_active_lock = threading.Lock()
+
+def log_file() -> str:
+    """
+    File of the records of the stages. It is `../data/logs/pipeline.jsonl`,
+    unless the environment variable `PIPELINE_LOG` gives another one (an
+    empty value disables the records). `pipeline.py` sets it to the `logs`
+    folder of its data root.
+    """
+    return os.environ.get('PIPELINE_LOG', '../data/logs/pipeline.jsonl')
+
+def profile_folder() -> str:
+    """
+    Folder of the cProfile files of the stages, given by the environment
+    variable `PIPELINE_PROFILE` (the stages are not profiled without it).
+    """
+    return os.environ.get('PIPELINE_PROFILE', '')
+
+def _stack() -> list:
+    """
+    Stages running in this thread, from the outermost to the innermost.
+    """
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def _rss() -> int:
+    """
+    Current resident memory of the process in bytes (None outside Linux).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def _peak_rss() -> int:
+    """
+    Peak resident memory of the process in bytes since the last
+    `_reset_peak_rss` (None outside Linux).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _reset_peak_rss() -> bool:
+    """
+    Reset the peak resident memory of the process to the current one. It
+    returns False when it is not possible (outside Linux).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def _io() -> dict:
+    """
+    Bytes read and written by the process so far (None outside Linux).
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return {'read': int(counters['rchar']), 'written': int(counters['wchar'])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+def _rows(value) -> int:
+    """
+    Number of rows of a table or array (or length of a list), None for the
+    other objects.
+    """
+    if isinstance(getattr(value, 'shape', None), tuple) and len(value.shape) > 0:
+        return int(value.shape[0])
+    if isinstance(value, list):
+        return len(value)
+    return None
+
+class Stage:
+    """
+    Context manager that measures a stage of the pipeline: wall time, CPU
+    time (of the process, of the thread of the stage and of its finished
+    children), peak resident memory during the stage, rows in and out, and
+    bytes read and written. When it exits, a record is appended as a json
+    line to `log_file()`. With `PIPELINE_PROFILE`, the outermost profiled
+    stage is also saved as a cProfile file (readable by pstats or snakeviz).
+
+    The peak memory of the stage is measured by resetting the peak of the
+    process when the stage starts (the stages already running keep the peak
+    reached so far). Outside Linux, it is the peak of the whole process.
+    The memory, the CPU time of the process and the bytes are counted for
+    the whole process, so when stages of other threads run at the same time
+    (as in `pipeline.py`) the record is marked as shared and only its
+    thread_cpu_time is of the stage alone.
+    """
+
+    def __init__(self, name, **counts) -> None:
+        """
+        - name (str): name of the stage.
+        - counts: initial counts, such as rows_in.
+        """
+        self.name = name
+        self.counts = {key: value for key, value in counts.items() if value is not None}
+        self.profiler = None
+        self.peak = None
+        self.shared = False
+
+    def add(self, **counts) -> None:
+        """
+        Add counts to the stage (for instance, rows_out=len(table)).
+        """
+        for key, value in counts.items():
+            if value is not None:
+                self.counts[key] = self.counts.get(key, 0) + value
+
+    def __enter__(self):
+        stack = _stack()
+        self.parent = stack[-1].name if len(stack) > 0 else None
+        stack.append(self)
+
+        self.thread = threading.get_ident()
+        with _active_lock:
+            # The stages already running keep their peak before it is reset.
+            peak = _peak_rss()
+            for other in _active:
+                other.peak = max(other.peak or 0, peak or 0)
+                if other.thread != self.thread:
+                    other.shared = True
+                    self.shared = True
+            self.peak_reset = _reset_peak_rss()
+            _active.append(self)
+
+        self.start = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = os.times()
+        self.start_thread_cpu = time.thread_time()
+        self.start_rss = _rss()
+        self.start_io = _io()
+
+        if profile_folder() != '':
+            try:
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+            except ValueError:
+                # Another stage (or tool) is already profiling.
+                self.profiler = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if self.profiler is not None:
+            self.profiler.disable()
+
+        end_cpu = os.times()
+        end_thread_cpu = time.thread_time()
+        end_io = _io()
+        _stack().pop()
+
+        with _active_lock:
+            _active.remove(self)
+            if self.peak_reset:
+                peak = max(self.peak or 0, _peak_rss() or 0)
+            else:
+                peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+        record = {'stage': self.name,
+                  'parent': self.parent,
+                  'status': 'ok' if exc_type is None else 'error',
+                  'start': self.start,
+                  'pid': os.getpid(),
+                  'wall_time': time.perf_counter() - self.start_wall,
+                  'cpu_time': sum(end_cpu[:2]) - sum(self.start_cpu[:2]),
+                  'thread_cpu_time': end_thread_cpu - self.start_thread_cpu,
+                  'children_cpu_time': sum(end_cpu[2:4]) - sum(self.start_cpu[2:4]),
+                  'rss_start': self.start_rss,
+                  'rss_end': _rss(),
+                  'peak_rss': peak,
+                  'peak_rss_scope': 'stage' if self.peak_reset else 'process',
+                  'shared': self.shared,
+                  'bytes_read': end_io['read'] - self.start_io['read'] if end_io and self.start_io else None,
+                  'bytes_written': end_io['written'] - self.start_io['written'] if end_io and self.start_io else None}
+        record.update(self.counts)
+
+        if self.profiler is not None:
+            folder = profile_folder()
+            os.makedirs(folder, exist_ok = True)
+            record['profile'] = os.path.join(folder, '{}-{}-{}.prof'.format(self.name, os.getpid(), int(self.start*1e6)))
+            self.profiler.dump_stats(record['profile'])
+
+        file_name = log_file()
+        if file_name != '':
+            folder = os.path.dirname(file_name)
+            if folder != '':
+                os.makedirs(folder, exist_ok = True)
+            with open(file_name, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+def stage(name = None):
+    """
+    Decorator that runs a function (or method) inside a `Stage`. The rows
+    of the first table or array argument are the rows in, and the rows of
+    the result are the rows out (when they are tables, arrays or lists).
+    - name (str): name of the stage. The default is the qualified name of
+      the function, such as `GraphConstruction.build_legislature`.
+    """
+    def decorator(function):
+        stage_name = name if name is not None else function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            rows_in = next((_rows(arg) for arg in list(args) + list(kwargs.values())
+                            if isinstance(getattr(arg, 'shape', None), tuple)), None)
+            with Stage(stage_name, rows_in = rows_in) as current:
+                result = function(*args, **kwargs)
+                current.add(rows_out = _rows(result))
+            return result
+
+        return wrapper
+    return decorator
+
+def record(**counts) -> None:
+    """
+    Add counts (such as rows_in, rows_out) to the innermost running stage.
+    Outside a stage, nothing is done.
+    """
+    stack = _stack()
+    if len(stack) > 0:
+        stack[-1].add(**counts)
+
+def read_log(file_name = None) -> pd.DataFrame:
+    """
+    Records of the stages as a table.
+    - file_name (str): the default is `log_file()`.
+    """
+    records = pd.read_json(file_name if file_name is not None else log_file(), lines = True)
+    records['start'] = pd.to_datetime(records.start, unit = 's')
+    return records
+
+def summary(file_name = None) -> pd.DataFrame:
+    """
+    Number of runs, total and mean wall time, CPU time and the largest peak
+    memory of each stage, sorted by the total wall time.
+    """
+    records = read_log(file_name)
+    return records.groupby('stage').agg(runs = ('wall_time', 'size'),
+                                        wall_time = ('wall_time', 'sum'),
+                                        mean_wall_time = ('wall_time', 'mean'),
+                                        cpu_time = ('cpu_time', 'sum'),
+                                        peak_rss = ('peak_rss', 'max')).sort_values('wall_time', ascending = False)
@@ -0,0 +1,291 @@
+#!/usr/bin/python
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import os
+import json
+
+def matrix_exists(path) -> bool:
+    """
+    Verify if the matrix saved in path (without extension) exists.
+    """
+    return os.path.exists(path + '.npy') and os.path.exists(path + '.npz')
+
+def _index_array(index) -> np.ndarray:
+    """
+    Typed array of the index. Objects (such as the voting ids) are saved as
+    fixed-width strings, so no pickle is needed.
+    """
+    array = np.asarray(index)
+    if array.dtype == object:
+        array = array.astype(str)
+    return array
+
+def _encode(values, dtype = None, quantize = False) -> tuple:
+    """
+    Values in lower precision. It returns the stored values, the scale of the
+    quantization (0 if not quantized) and the largest absolute error.
+    - dtype (type): float type of the values (for instance, np.float32 or
+      np.float16). The default is float64.
+    - quantize (bool): int8 codes of a uniform grid of 255 levels between
+      -max|value| and max|value|, where -128 means NaN. The error is at most
+      half the step of the grid.
+    """
+    if quantize:
+        largest = np.nanmax(np.abs(values)) if np.isfinite(values).any() else 0.0
+        scale = float(largest/127) if largest > 0 else 1.0
+        stored = np.round(np.nan_to_num(values/scale)).astype(np.int8)
+        stored[np.isnan(values)] = -128
+        decoded = _decode(stored, scale)
+    else:
+        scale = 0.0
+        stored = values.astype(dtype if dtype is not None else np.float64)
+        decoded = stored.astype(float)
+
+    error = np.abs(decoded - values)
+    error = float(np.nanmax(error)) if np.isfinite(error).any() else 0.0
+    return stored, scale, error
+
+def _decode(values, scale) -> np.ndarray:
+    """
+    Float values of the int8 codes of `_encode` (scale 0 means not quantized).
+    """
+    if scale == 0:
+        return values
+    decoded = values*np.float32(scale)
+    decoded[values == -128] = np.nan
+    return decoded
+
+def save_matrix(matrix, path, metadata = None, codebook = None, dtype = None, quantize = False) -> None:
+    """
+    Save a DataFrame in binary format. The values are saved in `path.npy`,
+    which can be memory-mapped, and the index, columns and metadata in
+    `path.npz`.
+    - matrix (DataFrame): matrix to be saved.
+    - path (str): file path without extension.
+    - metadata (dict): information saved together with the matrix (it must
+      be json serializable).
+    - codebook (list): if given, the values are saved as int8 codes of the
+      codebook, where -1 means NaN. All the non-NaN values must be in it.
+    - dtype (type): float type of the saved values, such as np.float32 or
+      np.float16 (see `_encode`). The default is float64.
+    - quantize (bool): save the values as int8 codes of a uniform grid (see
+      `_encode`).
+    When the precision is reduced, the largest absolute error is saved in the
+    metadata as 'error_bound'.
+    """
+    values = matrix.to_numpy(dtype = float)
+    metadata = dict(metadata) if metadata is not None else {}
+    scale = 0.0
+
+    if codebook is not None:
+        codebook = np.asarray(codebook, dtype = float)
+        order = np.argsort(codebook)
+        positions = np.searchsorted(codebook, values, sorter = order).clip(max = len(codebook) - 1)
+        codes = order[positions].astype(np.int8)
+        codes[np.isnan(values)] = -1
+        if not (np.isnan(values) | (codebook[codes] == values)).all():
+            raise Exception('There are values which are not in the codebook.')
+        values = codes
+    elif dtype is not None or quantize:
+        values, scale, metadata['error_bound'] = _encode(values, dtype, quantize)
+
+    np.save(path + '.npy', values)
+    np.savez(path + '.npz',
+             index = _index_array(matrix.index),
+             columns = _index_array(matrix.columns),
+             codebook = codebook if codebook is not None else np.array([]),
+             scale = np.array(scale),
+             metadata = np.array(json.dumps(metadata)))
+
+def save_sparse_matrix(matrix, path, metadata = None, threshold = None, top_k = None, dtype = None, 
+                       quantize = False) -> None:
+    """
+    Save only the strongest entries of a square matrix (for instance, an
+    adjacency matrix) in CSR format. The diagonal is always kept. The values
+    of the CSR matrix are saved in `path.npy` and its structure, the index,
+    the columns and the metadata in `path.npz`.
+    - matrix (DataFrame): square matrix to be saved.
+    - path (str): file path without extension.
+    - threshold (float): keep the entries greater than it.
+    - top_k (int): keep the k largest entries of each row (and their
+      symmetric ones).
+    - dtype (type), quantize (bool): precision of the values (see `_encode`).
+    The metadata gets 'exact_above': every dropped entry is at most this
+    value, so the links above any threshold greater or equal to it are all
+    in the sparse matrix. It gets 'error_bound' too (see `save_matrix`):
+    when the precision is reduced, a value within 'error_bound' of a
+    threshold can be rounded to the other side of it (for instance,
+    float32(0.6) > 0.6), so keep the default float64 for exact graphs.
+    """
+    values = matrix.to_numpy(dtype = float)
+    n = values.shape[0]
+
+    off_diagonal = values.copy()
+    np.fill_diagonal(off_diagonal, -np.inf)
+    off_diagonal[np.isnan(off_diagonal)] = -np.inf
+    keep = np.isfinite(off_diagonal)
+    exact_above = -np.inf
+
+    if threshold is not None:
+        keep &= off_diagonal > threshold
+        exact_above = max(exact_above, threshold)
+
+    if top_k is not None and top_k < n - 1:
+        kth = -np.partition(-off_diagonal, top_k - 1, axis = 1)[:, top_k - 1]
+        largest = np.zeros_like(keep)
+        np.put_along_axis(largest, np.argpartition(-off_diagonal, top_k - 1, axis = 1)[:, :top_k], True, axis = 1)
+        keep &= largest | largest.T
+        exact_above = max(exact_above, float(kth.max()))
+
+    np.fill_diagonal(keep, True)
+    keep &= ~np.isnan(values)
+    csr = sp.csr_matrix((values[keep], np.nonzero(keep)[1], np.r_[0, np.cumsum(keep.sum(axis = 1))]), shape = (n, n))
+
+    save_csr_matrix(csr, matrix.index, matrix.columns, path, metadata, exact_above, dtype, quantize)
+
+def save_csr_matrix(csr, index, columns, path, metadata = None, exact_above = None, dtype = None,
+                    quantize = False) -> None:
+    """
+    Save a sparse matrix in the format of `save_sparse_matrix`, so it is
+    loaded as a `SparseMatrix`.
+    - csr (csr_matrix): matrix to be saved.
+    - index, columns (array): labels of the rows and columns.
+    - path (str): file path without extension.
+    - exact_above (float): every entry missing in the CSR structure is at
+      most this value (None if no entry is missing).
+    - dtype (type), quantize (bool): precision of the values (see `_encode`).
+    """
+    metadata = dict(metadata) if metadata is not None else {}
+    csr = sp.csr_matrix(csr)
+    csr.sort_indices()
+
+    data, scale, metadata['error_bound'] = _encode(csr.data.astype(float), dtype, quantize)
+    metadata['exact_above'] = exact_above if exact_above is not None and np.isfinite(exact_above) else None
+
+    np.save(path + '.npy', data)
+    np.savez(path + '.npz',
+             index = _index_array(index),
+             columns = _index_array(columns),
+             codebook = np.array([]),
+             scale = np.array(scale),
+             indices = csr.indices,
+             indptr = csr.indptr,
+             metadata = np.array(json.dumps(metadata)))
+
+class SparseMatrix:
+    """
+    Square matrix with only some of its entries (see `save_sparse_matrix`),
+    as a CSR matrix with the labels of the rows and columns. The metadata is
+    in `attrs`, as in the DataFrames of `load_matrix`.
+    """
+
+    def __init__(self, csr, index, columns, attrs = None) -> None:
+        """
+        Init function.
+        - csr (csr_matrix): the kept entries.
+        - index, columns (array): labels of the rows and columns.
+        - attrs (dict): metadata.
+        """
+        self.csr = csr
+        self.index = pd.Index(index)
+        self.columns = pd.Index(columns)
+        self.attrs = attrs if attrs is not None else {}
+
+    @property
+    def shape(self) -> tuple:
+        return self.csr.shape
+
+    @property
+    def exact_above(self) -> float:
+        """
+        Every dropped entry is at most this value (-inf if none was dropped).
+        """
+        exact_above = self.attrs.get('exact_above')
+        return exact_above if exact_above is not None else -np.inf
+
+    def to_numpy(self, dtype = float, fill_value = np.nan) -> np.ndarray:
+        """
+        Dense matrix, with the dropped entries filled.
+        """
+        values = np.full(self.shape, fill_value, dtype = dtype)
+        coo = self.csr.tocoo()
+        values[coo.row, coo.col] = coo.data
+        return values
+
+    def to_dataframe(self, fill_value = np.nan) -> pd.DataFrame:
+        """
+        Dense DataFrame, with the dropped entries filled.
+        """
+        matrix = pd.DataFrame(self.to_numpy(fill_value = fill_value), index = self.index, columns = self.columns)
+        matrix.attrs = self.attrs
+        return matrix
+
+def load_matrix(path, mmap = True):
+    """
+    Load a matrix saved with `save_matrix` or `save_sparse_matrix`. When the
+    values are not coded, the DataFrame is a view of the memory-mapped file.
+    The coded values (codebook or quantized) are decoded into memory, so only
+    the int8 file is memory-mapped and the DataFrame is a float copy.
+    The sparse matrices are loaded as a `SparseMatrix` (the ones saved as
+    float16 have float32 values). The metadata is available in
+    `matrix.attrs`.
+    - path (str): file path without extension.
+    - mmap (bool): memory-map the values instead of reading them.
+    """
+    values = np.load(path + '.npy', mmap_mode = 'r' if mmap else None)
+
+    with np.load(path + '.npz') as info:
+        index = info['index']
+        columns = info['columns']
+        codebook = info['codebook']
+        scale = float(info['scale']) if 'scale' in info else 0.0
+        structure = (info['indices'], info['indptr']) if 'indptr' in info else None
+        metadata = json.loads(str(info['metadata']))
+
+    if codebook.size > 0:
+        values = np.append(codebook, np.nan)[values]
+    values = _decode(values, scale)
+
+    if structure is not None:
+        # scipy.sparse has no float16, so those values are widened (exactly).
+        if values.dtype == np.float16:
+            values = values.astype(np.float32)
+        csr = sp.csr_matrix((values, structure[0], structure[1]), shape = (len(index), len(columns)))
+        return SparseMatrix(csr, index, columns, metadata)
+
+    matrix = pd.DataFrame(values, index = index, columns = columns, copy = False)
+    matrix.attrs = metadata
+
+    return matrix
+
+def create_stack(path, shape, index, columns, metadata = None, dtype = np.float32) -> np.memmap:
+    """
+    Create a stack of matrices (for instance, windows x deputies x deputies)
+    in `path.npy`, memory-mapped so it can be filled one matrix at a time.
+    The labels of the first axis (index), of the other two (columns) and
+    the metadata are saved in `path.npz`.
+    - path (str): file path without extension.
+    - shape (tuple): shape of the stack.
+    """
+    stack = np.lib.format.open_memmap(path + '.npy', mode = 'w+', dtype = dtype, shape = shape)
+    np.savez(path + '.npz',
+             index = _index_array(index),
+             columns = _index_array(columns),
+             codebook = np.array([]),
+             metadata = np.array(json.dumps(metadata if metadata is not None else {})))
+    return stack
+
+def load_stack(path) -> tuple:
+    """
+    Load a stack saved with `create_stack`. It returns the memory-mapped
+    array, the index, the columns and the metadata.
+    - path (str): file path without extension.
+    """
+    stack = np.load(path + '.npy', mmap_mode = 'r')
+    with np.load(path + '.npz') as info:
+        index = info['index']
+        columns = info['columns']
+        metadata = json.loads(str(info['metadata']))
+    return stack, index, columns, metadata
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse import csgraph
+import os
+import json
+
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+
+from prepare_adjacency_matrix import GraphConstruction
+from matrix_storage import SparseMatrix
+from instrumentation import stage
+
+class NetworkMetrics:
+    """
+    Class to compute the statistics of the thresholded graphs of each
+    legislature directly from sparse (CSR) adjacency matrices, instead of
+    networkx graphs. The graph is the one of `get_graph` in the notebooks:
+    the links above the threshold, without self-loops, and without the
+    zero-degree deputies.
+    """
+
+    def __init__(self, data_root = '../data') -> None:
+        """
+        Init function. It creates all necessary folders.
+        - data_root (str): folder of the data (see `DataPreprocessing`).
+        """
+        self.data_root = data_root
+        self.graphConstrutor = GraphConstruction(data_root = data_root)
+        self.data_folder()
+
+    def data_folder(self) -> None:
+        """
+        Create the folder of the cached metrics.
+        """
+        if not os.path.exists(os.path.join(self.data_root, 'graphs/metrics')):
+            os.mkdir(os.path.join(self.data_root, 'graphs/metrics'))
+
+    def csr_graph(self, adjacency_matrix, threshold) -> tuple:
+        """
+        Sparse graph with the links of the adjacency matrix above the
+        threshold. It returns the CSR matrix, the deputies (in the same order)
+        and the number of zero-degree deputies that were removed.
+        """
+        if isinstance(adjacency_matrix, SparseMatrix) and threshold < adjacency_matrix.exact_above:
+            raise Exception('The sparse matrix only has the links above {}.'.format(adjacency_matrix.exact_above))
+        adj = adjacency_matrix.to_numpy(dtype = float) > threshold
+        np.fill_diagonal(adj, False)
+
+        keep = adj.any(axis = 1)
+        graph = sp.csr_matrix(adj[np.ix_(keep, keep)], dtype = np.int8)
+
+        return graph, adjacency_matrix.columns[keep], int((~keep).sum())
+
+    def shortest_paths(self, graph) -> tuple:
+        """
+        Average shortest path length and diameter with BFS from every node
+        (compiled in scipy). When the graph is disconnected, only the pairs
+        connected by a path are considered.
+        """
+        n = graph.shape[0]
+        if n < 2:
+            return 0.0, 0
+        distances = csgraph.shortest_path(graph, directed = False, unweighted = True)
+        reachable = np.isfinite(distances)
+        np.fill_diagonal(reachable, False)
+        if not reachable.any():
+            return 0.0, 0
+        return float(distances[reachable].mean()), int(distances[reachable].max())
+
+    def degree_assortativity(self, graph) -> float:
+        """
+        Pearson correlation between the degrees of the ends of the links.
+        """
+        if graph.nnz == 0:
+            return np.nan
+        degrees = np.asarray(graph.sum(axis = 1)).ravel()
+        rows, cols = graph.nonzero()
+        return float(np.corrcoef(degrees[rows], degrees[cols])[0, 1])
+
+    def attribute_assortativity(self, graph, labels) -> float:
+        """
+        Assortativity coefficient of a categorical attribute, computed from
+        the mixing matrix of the integer labels.
+        - labels (array): integer label of each node (-1 for unknown, which
+          is its own category, as None in networkx).
+        """
+        if graph.nnz == 0:
+            return np.nan
+        labels = np.asarray(labels) + 1
+        rows, cols = graph.nonzero()
+        k = labels.max() + 1
+        mixing = np.bincount(labels[rows]*k + labels[cols], minlength = k*k).reshape(k, k)
+        mixing = mixing/mixing.sum()
+        squared = (mixing @ mixing).sum()
+        if squared == 1:
+            return np.nan
+        return float((np.trace(mixing) - squared)/(1 - squared))
+
+    def modularity(self, graph, labels, resolution = 1) -> float:
+        """
+        Modularity of the partition given by integer labels, as
+        `networkx.algorithms.community.modularity`: the sum over the groups
+        of L_c/m - resolution*(d_c/2m)^2, where L_c is the number of links
+        inside the group and d_c the sum of its degrees.
+        - labels (array): integer label of each node (-1 for unknown, which
+          is its own group).
+        """
+        if graph.nnz == 0:
+            return np.nan
+        labels = np.asarray(labels) + 1
+        rows, cols = graph.nonzero()
+        weights = np.asarray(graph[rows, cols]).ravel().astype(float)
+        total = weights.sum()
+        inside = np.bincount(labels[rows], weights = weights*(labels[rows] == labels[cols]))
+        degrees = np.bincount(labels[rows], weights = weights)
+        return float(inside.sum()/total - resolution*((degrees/total)**2).sum())
+
+    def clustering(self, graph) -> tuple:
+        """
+        Local clustering coefficient of each node and the transitivity. The
+        triangles of each node are the diagonal of A^3, computed as the row
+        sums of (A @ A) * A.
+        """
+        degrees = np.asarray(graph.sum(axis = 1)).ravel().astype(float)
+        triangles = np.asarray((graph @ graph).multiply(graph).sum(axis = 1)).ravel().astype(float)
+        pairs = degrees*(degrees - 1)
+
+        local = np.divide(triangles, pairs, out = np.zeros_like(triangles), where = pairs > 0)
+        transitivity = triangles.sum()/pairs.sum() if pairs.sum() > 0 else 0.0
+
+        return local, float(transitivity)
+
+    def average_neighbor_degree(self, graph) -> np.ndarray:
+        """
+        Degree correlation function k_nn(k): average degree of the neighbors
+        of the nodes with degree k, as `degree_function` of the notebooks
+        (from the degree mixing matrix). It is 0 for the absent degrees.
+        """
+        degrees = np.asarray(graph.sum(axis = 1)).ravel().astype(int)
+        rows, cols = graph.nonzero()
+        size = degrees.max() + 1 if degrees.size > 0 else 1
+        total = np.bincount(degrees[rows], weights = degrees[cols], minlength = size)
+        count = np.bincount(degrees[rows], minlength = size)
+        return np.divide(total, count, out = np.zeros(size), where = count > 0)
+
+    @stage()
+    def compute(self, legislature, abstention_decision, obstruction_decision, threshold, verify = True) -> dict:
+        """
+        Statistics of the thresholded graph of a legislature. The result is
+        cached in `graphs/metrics/` of the data folder by legislature,
+        decisions and threshold, and it is computed again when the adjacency matrix or the
+        deputies changed (see `ResultCache`).
+        - verify (bool): use the cached result when it is fresh.
+        """
+        file_name = os.path.join(self.data_root, 'graphs/metrics/{}_{}_{}_{}.json'.format(
+                                     legislature, abstention_decision, obstruction_decision, threshold))
+        cache = self.graphConstrutor.cache
+        key = cache.key(self.graphConstrutor.adjacency_files(legislature, abstention_decision, obstruction_decision)
+                        + [os.path.join(self.data_root, 'tables/deputies.csv')], {'threshold': threshold})
+        if verify and cache.fresh(file_name, key):
+            with open(file_name) as f:
+                return json.load(f)
+
+        adjacency_matrix = self.graphConstrutor.import_adjacency_matrix(legislature, abstention_decision, obstruction_decision)
+        graph, nodes, zero_degree = self.csr_graph(adjacency_matrix, threshold)
+
+        deputies = self.graphConstrutor.deputies_store()
+        party = deputies.labels(legislature, nodes, 'siglaPartido')
+        region = deputies.labels(legislature, nodes, 'region')
+
+        average_path, diameter = self.shortest_paths(graph)
+        local_clustering, transitivity = self.clustering(graph)
+
+        metrics = {'legislature': legislature,
+                   'abstention_decision': abstention_decision,
+                   'obstruction_decision': obstruction_decision,
+                   'threshold': threshold,
+                   'number_nodes': graph.shape[0],
+                   'number_edges': int(graph.nnz//2),
+                   'number_zero_degree': zero_degree,
+                   'average_path': average_path,
+                   'diameter': diameter,
+                   'assortativity': self.degree_assortativity(graph),
+                   'assortativity_party': self.attribute_assortativity(graph, party),
+                   'assortativity_region': self.attribute_assortativity(graph, region),
+                   'average_clustering': float(local_clustering.mean()) if graph.shape[0] > 0 else 0.0,
+                   'transitivity': transitivity,
+                   'k_nn': self.average_neighbor_degree(graph).tolist()}
+
+        with open(file_name, 'w') as f:
+            json.dump(metrics, f)
+        cache.store(file_name, key, [file_name], group = 'metrics')
+
+        return metrics
+
+    def compute_legislatures(self, legislatures, abstention_decision, obstruction_decision, threshold,
+                             verify = True, workers = None) -> pd.DataFrame:
+        """
+        Statistics of many legislatures, computed in parallel processes (see
+        `compute`). It returns a table indexed by legislature.
+        - workers (int): number of processes. The default is the number of
+          cores.
+        """
+        n = len(legislatures)
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            results = executor.map(self.compute, legislatures, [abstention_decision]*n,
+                                   [obstruction_decision]*n, [threshold]*n, [verify]*n)
+            results = list(tqdm(results, total = n, desc = 'Legislature'))
+
+        return pd.DataFrame(results).set_index('legislature')
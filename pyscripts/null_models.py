@@ -0,0 +1,153 @@
+#!/usr/bin/python
+
+import pandas as pd
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+
+from concurrent.futures import ProcessPoolExecutor
+
+from network_metrics import NetworkMetrics
+from instrumentation import stage
+
+class NullModelEnsemble:
+    """
+    Ensemble of random graphs with the same degree sequence of a graph
+    (configuration model), generated by double edge swaps over arrays of
+    links. Independent chains run in different processes, each one with its
+    own seed derived from a single seed, so the ensemble is reproducible.
+    """
+
+    def __init__(self, data_root = '../data') -> None:
+        """
+        Init function.
+        - data_root (str): folder of the data (see `DataPreprocessing`).
+        """
+        self.metrics = NetworkMetrics(data_root = data_root)
+
+    def edge_list(self, graph, attribute = 'party') -> tuple:
+        """
+        Arrays of the links of a networkx graph (for instance, from
+        `GraphConstruction.build_graph_threshold`), without self-loops. It
+        returns the links as positions of the nodes, the number of nodes and
+        the integer label of each node for the attribute (-1 if unknown).
+        """
+        nodes = list(graph.nodes)
+        position = {node: i for i, node in enumerate(nodes)}
+        edges = np.array([(position[u], position[v]) for u, v in graph.edges if u != v], dtype = np.int64).reshape(-1, 2)
+
+        attributes = nx.get_node_attributes(graph, attribute)
+        labels = pd.factorize(pd.Series([attributes.get(node) for node in nodes], dtype = object))[0]
+
+        return edges, len(nodes), labels
+
+    def rewire(self, edges, n, nswap, rng) -> np.ndarray:
+        """
+        Perform nswap double edge swaps: the links (a, b) and (c, d) become
+        (a, d) and (c, b) (or (a, c) and (b, d)), unless this creates a
+        self-loop or a multiple link. The degrees of all nodes are preserved.
+        - edges (array): links, which is changed in place.
+        - n (int): number of nodes.
+        - nswap (int): number of proposed swaps.
+        - rng (Generator): random number generator.
+        """
+        m = edges.shape[0]
+        if m < 2:
+            return edges
+
+        existing = set((np.minimum(edges[:, 0], edges[:, 1])*n + np.maximum(edges[:, 0], edges[:, 1])).tolist())
+        first = rng.integers(0, m, nswap).tolist()
+        second = rng.integers(0, m, nswap).tolist()
+        cross = (rng.random(nswap) < 0.5).tolist()
+        links = edges.tolist()
+
+        for i, j, flip in zip(first, second, cross):
+            if i == j:
+                continue
+            a, b = links[i]
+            c, d = links[j]
+            if flip:
+                c, d = d, c
+            if a == d or c == b:
+                continue
+            new1 = min(a, d)*n + max(a, d)
+            new2 = min(c, b)*n + max(c, b)
+            if new1 in existing or new2 in existing or new1 == new2:
+                continue
+            existing.discard(min(a, b)*n + max(a, b))
+            existing.discard(min(c, d)*n + max(c, d))
+            existing.add(new1)
+            existing.add(new2)
+            links[i] = [a, d]
+            links[j] = [c, b]
+
+        edges[:] = links
+        return edges
+
+    def statistics(self, edges, n, labels) -> dict:
+        """
+        Clustering, assortativity and modularity of the attribute partition
+        of the graph given by the links.
+        """
+        rows = np.concatenate([edges[:, 0], edges[:, 1]])
+        cols = np.concatenate([edges[:, 1], edges[:, 0]])
+        graph = sp.csr_matrix((np.ones(len(rows), dtype = np.int8), (rows, cols)), shape = (n, n))
+
+        local_clustering, transitivity = self.metrics.clustering(graph)
+
+        return {'average_clustering': float(local_clustering.mean()),
+                'transitivity': transitivity,
+                'assortativity': self.metrics.degree_assortativity(graph),
+                'modularity': self.metrics.modularity(graph, labels)}
+
+    def chain(self, edges, n, labels, seed, samples, swaps_per_edge = 10) -> list:
+        """
+        One Markov chain of swaps starting from the real graph. After a burn-in
+        of swaps_per_edge swaps per link, a sample is taken every
+        swaps_per_edge swaps per link.
+        - seed (SeedSequence or int): seed of the chain.
+        - samples (int): number of samples of the chain.
+        """
+        rng = np.random.default_rng(seed)
+        edges = edges.copy()
+        nswap = swaps_per_edge*edges.shape[0]
+
+        self.rewire(edges, n, nswap, rng)
+        results = []
+        for _ in range(samples):
+            self.rewire(edges, n, nswap, rng)
+            results.append(self.statistics(edges, n, labels))
+
+        return results
+
+    @stage()
+    def ensemble(self, graph, attribute = 'party', chains = 8, samples_per_chain = 25,
+                 swaps_per_edge = 10, seed = 0, workers = None) -> tuple:
+        """
+        Compare the graph with its degree-preserving ensemble. It returns
+        the statistics of the graph, a table with the statistics of each
+        random graph and the z-scores of the graph against the ensemble.
+        - graph (nx.Graph): for instance, from
+          `GraphConstruction.build_graph_threshold` with the legislature.
+        - attribute (str): node attribute of the partition of the modularity.
+        - chains (int): number of independent chains.
+        - samples_per_chain (int): random graphs taken from each chain.
+        - swaps_per_edge (int): swaps per link of the burn-in and between
+          samples.
+        - seed (int): seed of the whole ensemble.
+        - workers (int): number of processes. The default is the number of
+          cores.
+        """
+        edges, n, labels = self.edge_list(graph, attribute)
+        real = self.statistics(edges, n, labels)
+
+        seeds = np.random.SeedSequence(seed).spawn(chains)
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            results = executor.map(self.chain, [edges]*chains, [n]*chains, [labels]*chains, seeds,
+                                   [samples_per_chain]*chains, [swaps_per_edge]*chains)
+            samples = pd.DataFrame([sample for result in results for sample in result])
+
+        real = pd.Series(real)
+        z_scores = (real - samples.mean())/samples.std()
+
+        return real, samples, z_scores
@@ -0,0 +1,248 @@
+#!/usr/bin/python
+
+import os
+import sys
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+class PipelineRunner:
+    """
+    Non-interactive runner of the pipeline, for scheduled jobs. The selected
+    stages run as soon as the stages they depend on are done, so the
+    independent ones (the raw downloads, the deputies, the fronts and the
+    propositions) run at the same time, each in a thread. The builds of the
+    legislatures are spread over a process pool. A stage whose dependency
+    failed is skipped, and the other stages still run. The modules of the
+    stages (pandas, networkx, DadosAbertosBrasil...) are imported only when
+    a stage needs them, so the runner starts fast.
+    """
+
+    # Stage -> stages it depends on.
+    dependencies = {'downloads': [],
+                    'deputies': [],
+                    'fronts': [],
+                    'votes': ['downloads'],
+                    'propositions': ['votes'],
+                    'incidence': ['votes'],
+                    'adjacency': ['incidence'],
+                    'themes': ['incidence', 'propositions'],
+                    'front_adjacency': ['fronts']}
+
+    # The configurations used by the project.
+    configurations = [('partial-unknown', 'against', False),
+                      ('same', 'same', True)]
+
+    def __init__(self, years = (2003, 2021), legislatures = range(52, 57), configurations = None,
+                 verify = True, refresh = False, yearly = True, workers = None, data_root = '../data') -> None:
+        """
+        - years (tuple): first and last years of the votings.
+        - legislatures (list): legislatures of the deputies and of the
+          adjacency matrices.
+        - configurations (list): tuples (abstention_decision,
+          obstruction_decision, agreement) of the adjacency matrices. The
+          default is the ones of the project.
+        - verify (bool): skip the artifacts already built from the same
+          inputs (see `ResultCache`).
+        - refresh (bool): download the raw files again if they changed in
+          the server.
+        - yearly (bool): build the incidence matrices of each year too.
+        - workers (int): number of processes of the builds of the
+          legislatures. The default is the number of cores.
+        - data_root (str): folder of the data (see `DataPreprocessing`).
+        """
+        self.years = tuple(years)
+        self.legislatures = list(legislatures)
+        self.configurations = configurations if configurations is not None else self.configurations
+        self.verify = verify
+        self.refresh = refresh
+        self.yearly = yearly
+        self.workers = workers
+        self.data_root = data_root
+
+        self.lock = threading.Lock()
+        self.instances = {}
+
+    def instance(self, name):
+        """
+        The `DataPreprocessing` or `GraphConstruction` shared by the stages,
+        created (and its module imported) by the first stage that needs it.
+        """
+        with self.lock:
+            if name not in self.instances:
+                if name == 'preprocessing':
+                    from prepare_data import DataPreprocessing
+                    self.instances[name] = DataPreprocessing(data_root = self.data_root)
+                else:
+                    from prepare_adjacency_matrix import GraphConstruction
+                    self.instances[name] = GraphConstruction(data_root = self.data_root)
+            return self.instances[name]
+
+    def downloads(self) -> None:
+        """
+        Raw voting files of the years (see `DataPreprocessing.download_necessary_files`).
+        """
+        self.instance('preprocessing').download_necessary_files(*self.years, refresh = self.refresh)
+
+    def deputies(self) -> None:
+        """
+        Deputies of the legislatures (see `DataPreprocessing.get_deputies`).
+        """
+        self.instance('preprocessing').get_deputies(min(self.legislatures), max(self.legislatures), verify = self.verify)
+
+    def fronts(self) -> None:
+        """
+        Parliamentary fronts (see `DataPreprocessing.get_fronts`).
+        """
+        self.instance('preprocessing').get_fronts(verify = self.verify)
+
+    def votes(self) -> None:
+        """
+        Voting tables of the years (see `DataPreprocessing.prepare_votes_table`).
+        """
+        self.instance('preprocessing').prepare_votes_table(*self.years, verify = self.verify)
+
+    def propositions(self) -> None:
+        """
+        Types and themes of the propositions of the votings (see
+        `DataPreprocessing.get_propositions`, which only fetches the new ones).
+        """
+        self.instance('preprocessing').get_propositions()
+
+    def incidence(self) -> None:
+        """
+        Incidence matrices (see `DataPreprocessing.incidence_matrix`).
+        """
+        self.instance('preprocessing').incidence_matrix(verify = self.verify, yearly = self.yearly)
+
+    def adjacency(self) -> None:
+        """
+        Adjacency matrices of each legislature (see
+        `GraphConstruction.build_legislature`).
+        """
+        graphConstrutor = self.instance('graphs')
+        legislatures = self.legislatures
+        if self.verify:
+            # No process is started for the legislatures already up to date.
+            legislatures = [legislature for legislature in legislatures
+                            if len(graphConstrutor.stale_configurations(legislature, self.configurations)) > 0]
+        self.fan_out(graphConstrutor.build_legislature, legislatures,
+                     configurations = self.configurations, verify = self.verify)
+
+    def themes(self) -> None:
+        """
+        Adjacency matrices of each theme and legislature (see
+        `GraphConstruction.build_theme_adjacency`).
+        """
+        self.fan_out(self.instance('graphs').build_theme_adjacency, self.legislatures,
+                     configurations = self.configurations, verify = self.verify)
+
+    def front_adjacency(self) -> None:
+        """
+        Co-membership adjacency matrices of the fronts of each legislature
+        (see `GraphConstruction.build_front_adjacency`).
+        """
+        self.fan_out(self.instance('graphs').build_front_adjacency, self.legislatures, verify = self.verify)
+
+    def fan_out(self, function, legislatures, **kwargs) -> list:
+        """
+        Run function(legislature, **kwargs) for each legislature in a process
+        pool and return the results.
+        """
+        if len(legislatures) == 0:
+            return []
+        with ProcessPoolExecutor(max_workers = self.workers) as executor:
+            builds = [executor.submit(function, legislature, **kwargs) for legislature in legislatures]
+            return [build.result() for build in builds]
+
+    def run(self, stages) -> dict:
+        """
+        Run the stages, each one when its selected dependencies are done (the
+        outputs of the stages not selected must already exist). It returns
+        the status of each stage: 'done', 'failed' or 'skipped'.
+        - stages (list): names of the stages (see `dependencies`).
+        """
+        for name in stages:
+            if name not in self.dependencies:
+                raise Exception('The stage {} was not programmed'.format(name))
+
+        pending = [name for name in self.dependencies if name in stages]
+        status = {}
+        running = {}
+
+        with ThreadPoolExecutor(max_workers = len(pending)) as executor:
+            while len(pending) > 0 or len(running) > 0:
+
+                for name in list(pending):
+                    dependencies = [dependency for dependency in self.dependencies[name] if dependency in stages]
+                    if any(status.get(dependency) in ['failed', 'skipped'] for dependency in dependencies):
+                        print('WARNING - Skipping {}, since a stage it depends on did not finish.'.format(name))
+                        status[name] = 'skipped'
+                        pending.remove(name)
+                    elif all(status.get(dependency) == 'done' for dependency in dependencies):
+                        print('MESSAGE - Starting the stage {}.'.format(name))
+                        running[executor.submit(getattr(self, name))] = name
+                        pending.remove(name)
+
+                if len(running) == 0:
+                    continue
+                finished, _ = wait(running, return_when = FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        status[name] = 'done'
+                        print('MESSAGE - The stage {} is done.'.format(name))
+                    except Exception as e:
+                        status[name] = 'failed'
+                        print('ERROR - The stage {} failed: {!r}'.format(name, e))
+
+        return status
+
+def main(argv = None) -> int:
+    """
+    Command-line entry point. It returns 0 when all the stages are done and
+    1 otherwise.
+    """
+    parser = argparse.ArgumentParser(description = 'Run the stages of the pipeline without prompts.')
+    parser.add_argument('--data-root', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data'),
+                        help = 'data folder (default: the data folder of the repository)')
+    parser.add_argument('--stages', nargs = '+', default = list(PipelineRunner.dependencies),
+                        choices = list(PipelineRunner.dependencies), metavar = 'STAGE',
+                        help = 'stages to run, among {} (default: all)'.format(', '.join(PipelineRunner.dependencies)))
+    parser.add_argument('--years', nargs = 2, type = int, default = [2003, 2021], metavar = ('YEAR1', 'YEAR2'),
+                        help = 'first and last years of the votings')
+    parser.add_argument('--legislatures', nargs = '+', type = int, default = list(range(52, 57)),
+                        help = 'legislatures of the deputies and of the adjacency matrices')
+    parser.add_argument('--workers', type = int, default = None,
+                        help = 'processes of the builds of the legislatures (default: number of cores)')
+    parser.add_argument('--force', action = 'store_true',
+                        help = 'build again the artifacts already built from the same inputs')
+    parser.add_argument('--refresh', action = 'store_true',
+                        help = 'download again the raw files that changed in the server')
+    parser.add_argument('--no-yearly', action = 'store_true',
+                        help = 'do not build the incidence matrices of each year')
+    args = parser.parse_args(argv)
+
+    # The processes are spawned, since a process forked while another stage
+    # uses the SQLite cache can find it locked (see `ResultCache`).
+    multiprocessing.set_start_method('spawn', force = True)
+
+    # The records of the stages go to the data root, also in the processes
+    # of the legislatures (see `instrumentation.log_file`).
+    os.environ.setdefault('PIPELINE_LOG', os.path.join(args.data_root, 'logs', 'pipeline.jsonl'))
+
+    runner = PipelineRunner(years = args.years, legislatures = args.legislatures, verify = not args.force,
+                            refresh = args.refresh, yearly = not args.no_yearly, workers = args.workers,
+                            data_root = args.data_root)
+    status = runner.run(args.stages)
+
+    for name, result in status.items():
+        print('INFO - {}: {}'.format(name, result))
+
+    return 0 if all(result == 'done' for result in status.values()) else 1
+
+if __name__ == '__main__':
+
+    sys.exit(main())
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+
+import os
+import time
+import json
+import hashlib
+import sqlite3
+
+class ResultCache:
+    """
+    Cache of the artifacts of the pipeline (tables, incidence and adjacency
+    matrices, metrics...) keyed by the content of their inputs and their
+    parameters. Each artifact is recomputed only when the digest of an input
+    file or a parameter changed, so the steps form a DAG: when a step
+    produces the same bytes again, the next steps are still fresh. The
+    manifest is a SQLite database, which is safe to use from many processes.
+    The digests of the files are memoized by size and modification time, so
+    checking a fresh artifact does not read its inputs again.
+    """
+
+    def __init__(self, file_name = None, data_root = '../data') -> None:
+        """
+        Init function. It creates the tables of the manifest.
+        - file_name (str): SQLite database of the manifest. The default is
+          `cache.sqlite` in the data folder.
+        - data_root (str): folder of the data (see `DataPreprocessing`).
+        """
+        self.file_name = file_name if file_name is not None else os.path.join(data_root, 'cache.sqlite')
+        with self.connect() as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS artifacts (name TEXT PRIMARY KEY, key TEXT,
+                                  outputs TEXT, size INTEGER, parameters TEXT, grp TEXT, last_used REAL)""")
+            connection.execute("""CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, size INTEGER,
+                                  mtime INTEGER, digest TEXT)""")
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        New connection to the manifest (one per call, so the object can be
+        sent to other processes).
+        """
+        return sqlite3.connect(self.file_name, timeout = 60)
+
+    def digest(self, path) -> str:
+        """
+        SHA-256 of the content of a file. It is only computed again when the
+        size or the modification time of the file changed. The memo is kept
+        by the real path, so the same file reached through another path (a
+        relative one or a link to the data folder) is not read again.
+        """
+        status = os.stat(path)
+        path = os.path.realpath(path)
+
+        with self.connect() as connection:
+            row = connection.execute("SELECT size, mtime, digest FROM digests WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == status.st_size and row[1] == status.st_mtime_ns:
+            return row[2]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+
+        with self.connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)",
+                               (path, status.st_size, status.st_mtime_ns, digest))
+        return digest
+
+    def key(self, inputs = (), parameters = None) -> str:
+        """
+        Key of an artifact: the hash of the digests of the input files (in
+        the given order, so it does not depend on where the data folder is)
+        and of the parameters.
+        - inputs (list): paths of the input files.
+        - parameters (dict): json serializable parameters, such as the vote
+          mapping or the decisions.
+        """
+        content = {'inputs': [self.digest(path) for path in inputs], 'parameters': parameters}
+        return hashlib.sha256(json.dumps(content, sort_keys = True, default = str).encode()).hexdigest()
+
+    def fresh(self, name, key) -> bool:
+        """
+        Verify if the artifact was saved with this key and all its outputs
+        still exist. A fresh artifact is marked as used.
+        """
+        with self.connect() as connection:
+            row = connection.execute("SELECT key, outputs FROM artifacts WHERE name = ?", (name,)).fetchone()
+        if row is None or row[0] != key or not all(os.path.exists(self.absolute(path)) for path in json.loads(row[1])):
+            return False
+        self.touch(name)
+        return True
+
+    def store(self, name, key, outputs, parameters = None, group = None) -> None:
+        """
+        Save the key of an artifact after it was computed.
+        - outputs (list): paths of the files of the artifact.
+        - parameters (dict): parameters of the artifact, which can be read
+          back with `parameters`.
+        - group (str): group of artifacts evicted together (see `evict`).
+        """
+        outputs = list(dict.fromkeys(self.relative(path) for path in outputs))
+        size = sum(os.path.getsize(self.absolute(path)) for path in outputs if os.path.exists(self.absolute(path)))
+        with self.connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (name, key, json.dumps(outputs), size, json.dumps(parameters, default = str),
+                                group, time.time()))
+
+    def touch(self, name) -> None:
+        """
+        Mark an artifact as used now (for the LRU eviction).
+        """
+        with self.connect() as connection:
+            connection.execute("UPDATE artifacts SET last_used = ? WHERE name = ?", (time.time(), name))
+
+    def parameters(self, name) -> dict:
+        """
+        Parameters saved with the artifact (None if it is not in the cache).
+        """
+        with self.connect() as connection:
+            row = connection.execute("SELECT parameters FROM artifacts WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def outputs(self, name) -> list:
+        """
+        Files of the artifact (empty if it is not in the cache).
+        """
+        with self.connect() as connection:
+            row = connection.execute("SELECT outputs FROM artifacts WHERE name = ?", (name,)).fetchone()
+        return [self.absolute(path) for path in json.loads(row[0])] if row is not None else []
+
+    def relative(self, path) -> str:
+        """
+        Path of an output relative to the folder of the manifest (the data
+        folder), so the manifest does not depend on the working folder.
+        """
+        folder = os.path.dirname(os.path.abspath(self.file_name))
+        try:
+            return os.path.relpath(os.path.abspath(path), folder)
+        except ValueError:
+            # Another drive, on Windows.
+            return os.path.abspath(path)
+
+    def absolute(self, path) -> str:
+        """
+        Path of an output saved with `relative`.
+        """
+        return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(self.file_name)), path))
+
+    def evict(self, group, max_bytes = None, max_entries = None) -> list:
+        """
+        Remove the least recently used artifacts of a group (and their files)
+        until the group has at most max_bytes and max_entries. It returns
+        the names of the removed artifacts.
+        """
+        with self.connect() as connection:
+            rows = connection.execute("SELECT name, outputs, size FROM artifacts WHERE grp = ? ORDER BY last_used DESC",
+                                      (group,)).fetchall()
+
+        removed = []
+        total = 0
+        for i, (name, outputs, size) in enumerate(rows):
+            total += size
+            # The most recent artifact is always kept.
+            if i == 0 or ((max_bytes is None or total <= max_bytes) and (max_entries is None or i < max_entries)):
+                continue
+            for path in json.loads(outputs):
+                try:
+                    os.remove(self.absolute(path))
+                except FileNotFoundError:
+                    pass
+            removed.append(name)
+
+        if len(removed) > 0:
+            with self.connect() as connection:
+                connection.executemany("DELETE FROM artifacts WHERE name = ?", [(name,) for name in removed])
+        return removed
@@ -1,11 +1,16 @@
 #!/usr/bin/python
 
 import pandas as pd
-import networkx as nx
 import numpy as np
+import scipy.sparse as sp
 import os 
+import ast
 
-from tqdm import trange
+from matrix_storage import save_matrix, save_sparse_matrix, save_csr_matrix, load_matrix, matrix_exists, create_stack, load_stack, SparseMatrix
+from threshold_sweep import ThresholdSweep
+from deputies_store import DeputiesStore
+from instrumentation import stage, record
+from pipeline_cache import ResultCache
 
 class GraphConstruction: 
     """
@@ -13,44 +18,148 @@ class GraphConstruction:
     necessaries for the project. 
     """
 
-    def __init__(self) -> None:
+    def __init__(self, cache_bytes = None, data_root = '../data') -> None:
         """
         Init function. It creates all necessary folders. 
+        - data_root (str): folder of the data (see `DataPreprocessing`). 
+        - cache_bytes (int): maximum size of the saved adjacency matrices (and
+          their sums). The least recently used ones are removed beyond it
+          (see `ResultCache.evict`). The default is no limit. 
         """
+        self.deputies = None
+        self.cache_bytes = cache_bytes
+        self.data_root = data_root
         self.data_folder()
+        self.cache = ResultCache(data_root = data_root)
 
     def data_folder(self) -> None: 
         """
         Create the data folder structure. 
         """
-        if not os.path.exists('../data/graphs'):
-            os.mkdir('../data/graphs/')
+        if not os.path.exists(os.path.join(self.data_root, 'graphs')):
+            os.makedirs(os.path.join(self.data_root, 'graphs'))
 
-    def import_incidence_matrix(self, legislature, year = None):
+        if not os.path.exists(os.path.join(self.data_root, 'graphs/sums')):
+            os.mkdir(os.path.join(self.data_root, 'graphs/sums'))
 
+    def import_incidence_matrix(self, legislature, year = None):
+        """
+        Import the incidence matrix of a legislature (or of a year inside it).
+        The votes are saved as int8 codes, which are decoded into a float64
+        DataFrame in memory (see `load_matrix`), so it takes 8 bytes per vote
+        once imported. The old csv files are still read when there is no
+        binary file. 
+        """
         if year is None: 
-            file_name = '../data/tables/incidence_matrix_{}.csv'.format(legislature) 
+            file_name = os.path.join(self.data_root, 'tables/incidence_matrix_{}'.format(legislature)) 
         else: 
-            file_name = '../data/tables/incidence_matrix_{}_year_{}.csv'.format(legislature, year) 
+            file_name = os.path.join(self.data_root, 'tables/incidence_matrix_{}_year_{}'.format(legislature, year)) 
 
-        incidence_matrix = pd.read_csv(file_name, index_col = 0)
+        if matrix_exists(file_name): 
+            incidence_matrix = load_matrix(file_name)
+        else: 
+            incidence_matrix = pd.read_csv(file_name + '.csv', index_col = 0)
         return incidence_matrix
 
     def import_adjacency_matrix(self, legislature, abstention_decision, obstruction_decision):
-
+        """
+        Import the adjacency matrix of a legislature given the decisions. The
+        binary file is memory-mapped (unless it was quantized, see
+        `load_matrix`), and the sparse ones are imported as a
+        `SparseMatrix` (see `save_adjacency_matrix`). The old csv files are
+        still read when there is no binary file. 
+        """
         name = "adjacency_matrix_legislature_{}_{}_{}".format(legislature, abstention_decision, obstruction_decision)
-        file_name = '../data/graphs/{}.csv'.format(name) 
+        file_name = os.path.join(self.data_root, 'graphs/{}'.format(name)) 
 
-        adjacency_matrix = pd.read_csv(file_name, index_col = 0)
-        adjacency_matrix.rename(columns = {i: int(i) for i in adjacency_matrix.columns}, inplace = True)
+        if matrix_exists(file_name): 
+            adjacency_matrix = load_matrix(file_name)
+        else: 
+            adjacency_matrix = pd.read_csv(file_name + '.csv', index_col = 0)
+            adjacency_matrix.rename(columns = {i: int(i) for i in adjacency_matrix.columns}, inplace = True)
+        self.cache.touch(name)
 
         return adjacency_matrix
 
-    def save_adjacency_matrix(self, adjacency_matrix, name): 
-        
-        adjacency_matrix.to_csv('../data/graphs/{}.csv'.format(name))
+    def incidence_files(self, legislature): 
+        """
+        Files of the incidence matrix of a legislature (binary or csv). 
+        """
+        file_name = os.path.join(self.data_root, 'tables/incidence_matrix_{}'.format(legislature))
+        if matrix_exists(file_name): 
+            return [file_name + '.npy', file_name + '.npz']
+        return [file_name + '.csv']
+
+    def adjacency_files(self, legislature, abstention_decision, obstruction_decision): 
+        """
+        Files of the adjacency matrix of a legislature given the decisions
+        (binary or csv). 
+        """
+        file_name = os.path.join(self.data_root, 'graphs/adjacency_matrix_legislature_{}_{}_{}'.format(
+                                     legislature, abstention_decision, obstruction_decision))
+        if matrix_exists(file_name): 
+            return [file_name + '.npy', file_name + '.npz']
+        return [file_name + '.csv']
+
+    def adjacency_key(self, legislature, configuration, storage = None): 
+        """
+        Cache key of an adjacency matrix: the incidence matrix of the
+        legislature, the decisions and the storage options. 
+        """
+        return self.cache.key(self.incidence_files(legislature), 
+                              {'legislature': legislature, 'configuration': list(configuration), 'storage': storage or {}})
+
+    def stale_configurations(self, legislature, configurations, storage = None): 
+        """
+        Configurations whose adjacency matrix is not in the cache or was
+        built from another incidence matrix. 
+        """
+        name = "adjacency_matrix_legislature_{}_{}_{}"
+        return [par for par in configurations 
+                if not self.cache.fresh(name.format(legislature, par[0], par[1]), self.adjacency_key(legislature, par, storage))]
+
+    def store_adjacency(self, legislature, configuration, storage = None): 
+        """
+        Save the key of an adjacency matrix (and of its sums) in the cache,
+        and remove the least recently used ones beyond `cache_bytes`. 
+        """
+        name = "adjacency_matrix_legislature_{}_{}_{}".format(legislature, configuration[0], configuration[1])
+        outputs = [os.path.join(self.data_root, 'graphs/{}{}'.format(name, extension)) for extension in ['.npy', '.npz']]
+        outputs += [os.path.join(self.data_root, 'graphs/sums/{}_{}{}'.format(name, part, extension)) for part in ['numerator', 'denominator'] 
+                    for extension in ['.npy', '.npz'] 
+                    if matrix_exists(os.path.join(self.data_root, 'graphs/sums/{}_{}'.format(name, part)))]
+        self.cache.store(name, self.adjacency_key(legislature, configuration, storage), outputs, 
+                         {'legislature': legislature, 'configuration': list(configuration)}, group = 'adjacency')
+
+        if self.cache_bytes is not None: 
+            self.cache.evict('adjacency', max_bytes = self.cache_bytes)
+
+    def save_adjacency_matrix(self, adjacency_matrix, name, metadata = None, dtype = None, quantize = False, 
+                              threshold = None, top_k = None): 
+        """
+        Save the adjacency matrix in binary format (see `matrix_storage`). 
+        - metadata (dict): information saved with the matrix, such as the
+          decisions. 
+        - dtype (type): float type of the weights, such as np.float32 or
+          np.float16. The default is float64, which keeps the graphs
+          exact at any threshold. 
+        - quantize (bool): save the weights as int8 codes. 
+        - threshold (float): keep only the links above it (sparse matrix). 
+        - top_k (int): keep only the k strongest links of each deputy
+          (sparse matrix). 
+        The largest error of the weights is saved in the metadata as
+        'error_bound' and, for the sparse matrices, the graphs are exact for
+        the thresholds from 'exact_above' on. 
+        """
+        file_name = os.path.join(self.data_root, 'graphs/{}'.format(name))
+        if threshold is not None or top_k is not None: 
+            save_sparse_matrix(adjacency_matrix, file_name, metadata = metadata, threshold = threshold, top_k = top_k, 
+                               dtype = dtype, quantize = quantize)
+        else: 
+            save_matrix(adjacency_matrix, file_name, metadata = metadata, dtype = dtype, quantize = quantize)
         return 
 
+    @stage()
     def build_adjacency_matrix(self, incidence_matrix, abstention_decision, obstruction_decision, agreement = False): 
         """
         This functions builds the adjacency matrix given a decision: 
@@ -60,122 +169,766 @@ class GraphConstruction:
         - The 0.1 is replaced depending on the decision.
         - The 0 is replaced depending on the decision.
         """
-        incidence_matrix = incidence_matrix.replace({17: np.nan, 278: np.nan, 255: np.nan, 0.5: np.nan})
+        n = incidence_matrix.shape[0]
+        numerator, denominator = self.pair_sums(incidence_matrix, abstention_decision, obstruction_decision, agreement)
+        
+        return self.adjacency_from_sums(numerator, denominator, n, incidence_matrix.columns)
+
+    def pair_sums(self, incidence_matrix, abstention_decision, obstruction_decision, agreement = False): 
+        """
+        Sums over the votings of the contributions of each pair of deputies
+        (see `build_adjacency_matrix`). It returns the numerator and the
+        denominator (None, unless it is 'same' with agreement). Both are
+        additive in the votings, so new votings can be added to them. 
+        """
+        m = incidence_matrix.shape[1]
+        votes = self.clean_votes(incidence_matrix, abstention_decision, obstruction_decision)
+        indicators = self.vote_indicators(votes)
+        denominator = None
+
+        if abstention_decision == 'unknown' or abstention_decision == 'strong': 
+            numerator = votes.T @ votes
+        elif abstention_decision == 'partial': 
+            half = indicators.get(0.5, np.zeros_like(votes))
+            against = indicators.get(-1.0, np.zeros_like(votes))
+            numerator = votes.T @ votes + 0.25*(half.T @ half) + against.T @ half + half.T @ against
+        elif abstention_decision == 'partial-unknown': 
+            # Equal votes count +1 and opposite votes count -1. The pairs where
+            # both are missing cancel out, so only the non-zero values matter.
+            numerator = self.equal_votes(indicators, m) - self.opposite_votes(indicators, m)
+        elif abstention_decision == 'same': 
+            equal = self.equal_votes(indicators, m)
+            present = 1.0*(votes != 0)
+            copresence = present.T @ present
+            if agreement == True:
+                numerator, denominator = equal, copresence
+            else: 
+                numerator = 2*equal - copresence
+
+        return numerator, denominator
+
+    def adjacency_from_sums(self, numerator, denominator, n, columns): 
+        """
+        Adjacency matrix from the sums of `pair_sums` over n votings. 
+        """
+        if denominator is not None: 
+            adj = n*np.divide(numerator, denominator, out = np.zeros_like(numerator), where = denominator != 0)
+        else: 
+            adj = numerator.copy()
+
+        # The diagonal is kept as 1 (before the normalization) as done by
+        # the previous `DataFrame.corr` implementation. 
+        np.fill_diagonal(adj, 1.0)
+        adj = pd.DataFrame(adj/n, index = columns, columns = columns)
+
+        return adj
+
+    @stage()
+    def build_adjacency_matrices(self, incidence_matrix, configurations): 
+        """
+        Build the adjacency matrices of many configurations at once (see
+        `batch_pair_sums`). 
+        - incidence_matrix (DataFrame): votings x deputies. 
+        - configurations (list): tuples (abstention_decision,
+          obstruction_decision, agreement). 
+        It returns a list with the adjacency matrices, in the same order, as
+        `build_adjacency_matrix` would. 
+        """
+        n = incidence_matrix.shape[0]
+        return [self.adjacency_from_sums(numerator, denominator, n, incidence_matrix.columns) 
+                for numerator, denominator in self.batch_pair_sums(incidence_matrix, configurations)]
+
+    def batch_pair_sums(self, incidence_matrix, configurations): 
+        """
+        The `pair_sums` of many configurations at once. Apart from the
+        'strong' abstention (which depends on the majority of each voting),
+        every metric is a sum over the votings of a function of the votes of
+        the pair. Therefore, the counts of each pair of raw votes are
+        computed once and each configuration is a weighted sum of them. 
+        """
+        m = incidence_matrix.shape[1]
+        votes = incidence_matrix.to_numpy(dtype = float)
+        raw, cleaned = self.raw_votes(votes, configurations)
+        indicators = {value: 1.0*(votes == value) for value in raw}
+        counts = self.raw_counts(indicators)
+
+        sums = []
+        for abstention_decision, obstruction_decision, agreement in configurations: 
+
+            if abstention_decision == 'strong': 
+                sums.append(self.pair_sums(incidence_matrix, abstention_decision, obstruction_decision, agreement))
+            else: 
+                sums.append(self.sums_from_counts(counts, cleaned[abstention_decision, obstruction_decision], 
+                                                  abstention_decision, agreement, m))
+
+        return sums
+
+    def raw_votes(self, votes, configurations): 
+        """
+        Distinct raw votes that contribute to some configuration (the ones
+        always 0 after cleaning do not) and, for each pair of decisions
+        except the 'strong' abstention, the table raw vote -> cleaned vote. 
+        """
+        raw = np.array([value for value in np.unique(votes) if not np.isnan(value)])
+
+        cleaned = {}
+        for abstention_decision, obstruction_decision, _ in configurations: 
+            if abstention_decision != 'strong': 
+                cleaned[abstention_decision, obstruction_decision] = dict(zip(raw, self.clean_values(raw, abstention_decision, obstruction_decision)))
+
+        raw = [value for value in raw if any(table[value] != 0 for table in cleaned.values())]
+        return raw, cleaned
+
+    def raw_counts(self, indicators): 
+        """
+        Number of votings where each pair of deputies voted each pair of raw
+        votes (a, b), with a <= b. 
+        - indicators (dict): raw vote -> (votes == raw vote) as float arrays. 
+        """
+        raw = list(indicators)
+        counts = {}
+        for i, a in enumerate(raw): 
+            for b in raw[i:]: 
+                counts[a, b] = indicators[a].T @ indicators[b]
+        return counts
+
+    def sums_from_counts(self, counts, table, abstention_decision, agreement, m): 
+        """
+        Sums of `pair_sums` as weighted sums of the counts of the pairs of raw
+        votes (see `raw_counts`), given the table raw vote -> cleaned vote. 
+        """
+        metric = self.pair_metric(abstention_decision, agreement)
+        numerator = np.zeros((m, m))
+        denominator = np.zeros((m, m))
+
+        for (a, b), count in counts.items(): 
+            num_ab, den_ab = metric(table[a], table[b])
+            num_ba, den_ba = metric(table[b], table[a])
+            if a == b: 
+                numerator += num_ab*count
+                denominator += den_ab*count
+            else: 
+                numerator += num_ab*count + num_ba*count.T
+                denominator += den_ab*count + den_ba*count.T
+
+        if abstention_decision == 'same' and agreement == True: 
+            return numerator, denominator
+        return numerator, None
+
+    def clean_votes(self, incidence_matrix, abstention_decision, obstruction_decision): 
+        """
+        Apply the decisions of `build_adjacency_matrix` to the incidence
+        matrix. The votes are coded as integers and the decisions are applied
+        to the distinct values only (a lookup table). For the 'strong'
+        abstention, the abstentions take the sign of the sum of each voting.
+        It returns the cleaned votes as an array, where 0 means unknown. 
+        """
+        values, codes = np.unique(incidence_matrix.to_numpy(dtype = float), return_inverse = True)
+        codes = codes.reshape(incidence_matrix.shape)
+
+        votes = self.clean_values(values, abstention_decision, obstruction_decision)[codes]
+
+        if abstention_decision == 'strong': 
+            majority = np.sign(votes.sum(axis = 1))
+            abstention = (values == 0)[codes]
+            votes[abstention] = np.broadcast_to(majority[:, None], votes.shape)[abstention]
+
+        return votes
+
+    def clean_values(self, values, abstention_decision, obstruction_decision): 
+        """
+        Apply the decisions of `build_adjacency_matrix` to an array of votes,
+        except the majority replacement of the 'strong' abstention. The
+        unknown votes become 0. 
+        """
+        values = np.asarray(values, dtype = float)
+        cleaned = values.copy()
+        cleaned[np.isin(values, [17, 278, 255, 0.5])] = np.nan
+
         if obstruction_decision == 'against': 
-            incidence_matrix = incidence_matrix.replace({0.1: -1}) 
+            cleaned[values == 0.1] = -1
         elif obstruction_decision == 'unknown': 
-            incidence_matrix = incidence_matrix.replace({0.1: np.nan})
+            cleaned[values == 0.1] = np.nan
         elif obstruction_decision == 'same':
             pass
         else: 
             raise Exception('The decision for obstruction {} was not programmed'.format(obstruction_decision))
-        
-        if abstention_decision == 'unknown': 
+
+        if abstention_decision == 'unknown' or abstention_decision == 'strong': 
             pass
         elif abstention_decision == 'partial' or abstention_decision == 'partial-unknown' or abstention_decision == 'same': 
-            incidence_matrix = incidence_matrix.replace({0: 0.5})
-        elif abstention_decision == 'strong': 
-            for voting, votes in incidence_matrix.iterrows():  
-                majority = np.sign(votes.sum()) 
-                incidence_matrix.loc[voting] = incidence_matrix.loc[voting].replace({0: majority})
+            cleaned[values == 0] = 0.5
         else: 
             raise Exception('The decision for abstention {} was not programmed'.format(abstention_decision))
-            
-        incidence_matrix = incidence_matrix.fillna(0)
-        
-        n = incidence_matrix.shape[0]
-        
+
+        return np.nan_to_num(cleaned, nan = 0.0)
+
+    def pair_metric(self, abstention_decision, agreement = False): 
+        """
+        Contribution of a voting to the metric of a pair of deputies that
+        voted x and y (after cleaning). The function returns the contribution
+        to the numerator and to the denominator, which is only used by 'same'
+        with agreement. 
+        """
         if abstention_decision == 'unknown' or abstention_decision == 'strong': 
-            metric = lambda u1, u2: np.inner(u1, u2)
+            return lambda x, y: (x*y, 0)
         elif abstention_decision == 'partial': 
-            metric = lambda u1, u2: np.inner(u1, u2) + sum(0.25*((u1 == u2)&(u1 == 0.5)) + 1*(u1 + u2 == -0.5))
+            return lambda x, y: (x*y + 0.25*(x == y == 0.5) + 1*(x + y == -0.5), 0)
         elif abstention_decision == 'partial-unknown': 
-            metric = lambda u1, u2: sum(1*(u1 - u2 == 0) - 1*(u1 + u2 == 0))
+            return lambda x, y: (1*(x == y) - 1*(x + y == 0), 0)
         elif abstention_decision == 'same': 
-            if agreement == True:
-                def metric(u1, u2): 
-                    s = sum((u1!=0)&(u2!=0))
-                    if s == 0: return 0 
-                    else: 
-                        return n*sum((u1==u2)&(u1!=0))/s
+            if agreement == True: 
+                return lambda x, y: (1*((x == y) and (x != 0)), 1*((x != 0) and (y != 0)))
             else: 
-                metric = lambda u1, u2: sum(1*((u1!=0)*(u2!=0)*(1*(u1 == u2) - 1*(u1 != u2))))
-            
-        adj = incidence_matrix.corr(method = metric)/n 
-        
-        return adj
+                return lambda x, y: (1*((x != 0) and (y != 0))*(1*(x == y) - 1*(x != y)), 0)
+        else: 
+            raise Exception('The decision for abstention {} was not programmed'.format(abstention_decision))
+
+    @stage()
+    def build_legislature(self, legislature, configurations, verify = True, storage = None): 
+        """
+        Build and save the adjacency matrices of a legislature for all the
+        configurations (see `build_adjacency_matrices`). The sums over the
+        votings are saved too, so new votings can be added later (see
+        `update_legislature`). 
+        - verify (bool): skip the configurations already built from the
+          same incidence matrix (see `stale_configurations`). 
+        - storage (dict): precision and sparsity of the saved matrices (the
+          options of `save_adjacency_matrix`). 
+        """
+        storage = storage if storage is not None else {}
+        name = "adjacency_matrix_legislature_{}_{}_{}"
+        if verify: 
+            configurations = self.stale_configurations(legislature, configurations, storage)
+        if len(configurations) == 0: 
+            return
+
+        incidence_matrix = self.import_incidence_matrix(legislature)
+        n = incidence_matrix.shape[0]
+        columns = incidence_matrix.columns
+        record(rows_in = n, rows_out = len(configurations))
+
+        for par, (numerator, denominator) in zip(configurations, self.batch_pair_sums(incidence_matrix, configurations)): 
+            metadata = {'legislature': legislature, 
+                        'abstention_decision': par[0], 
+                        'obstruction_decision': par[1], 
+                        'agreement': par[2]}
+            self.save_pair_sums(numerator, denominator, incidence_matrix.index, columns, 
+                                name.format(legislature, par[0], par[1]), metadata)
+            self.save_adjacency_matrix(self.adjacency_from_sums(numerator, denominator, n, columns), 
+                                       name.format(legislature, par[0], par[1]), metadata = metadata, **storage)
+            self.store_adjacency(legislature, par, storage)
+
+    @stage()
+    def update_legislature(self, legislature, configurations, voting_ids, storage = None): 
+        """
+        Add new votings to the adjacency matrices of a legislature. The
+        incidence matrix must already have the new votings (see
+        `DataPreprocessing.update_votes`). Only the sums of the new votings
+        are computed and added to the saved ones (a rank-k update). The
+        votings already in the saved sums are skipped, so it can be called
+        again with the same ids. The configurations without saved sums, or
+        whose sums do not add up to the incidence matrix with the new
+        votings, are built from scratch. 
+        - voting_ids (list): ids of the new votings (the ones from other
+          legislatures are ignored). 
+        - storage (dict): options of `save_adjacency_matrix`. 
+        """
+        storage = storage if storage is not None else {}
+        name = "adjacency_matrix_legislature_{}_{}_{}"
+        stored = [par for par in configurations 
+                  if matrix_exists(os.path.join(self.data_root, 'graphs/sums/{}_numerator'.format(name.format(legislature, par[0], par[1]))))]
+        missing = [par for par in configurations if par not in stored]
+
+        incidence_matrix = self.import_incidence_matrix(legislature)
+        index = incidence_matrix.index
+
+        # Configurations grouped by the rows of the incidence matrix missing in their sums. 
+        updates = {}
+        for par in stored: 
+            sums = self.import_pair_sums(name.format(legislature, par[0], par[1]))
+            votings = sums[2]
+            new = index.isin(voting_ids) & ~index.isin(votings if votings is not None else [])
+            if votings is None or not votings.isin(index).all() or len(votings) + new.sum() != len(index): 
+                print("WARNING - The saved sums of {} do not match the incidence matrix, building them again.".format(
+                      name.format(legislature, par[0], par[1])))
+                missing.append(par)
+                continue
+            updates.setdefault(tuple(np.flatnonzero(new)), []).append((par, sums))
+
+        self.build_legislature(legislature, missing, verify = False, storage = storage)
+
+        columns = incidence_matrix.columns
+        for rows, group in updates.items(): 
+            if len(rows) == 0: 
+                continue
+            new_votings = incidence_matrix.iloc[list(rows)]
+
+            for (par, sums), (numerator, denominator) in zip(group, self.batch_pair_sums(new_votings, [par for par, _ in group])): 
+                numerator_old, denominator_old, votings, columns_old = sums
+
+                # New deputies have no contribution from the old votings. 
+                numerator += pd.DataFrame(numerator_old, index = columns_old, columns = columns_old).reindex(
+                                index = columns, columns = columns, fill_value = 0).to_numpy()
+                if denominator is not None: 
+                    denominator += pd.DataFrame(denominator_old, index = columns_old, columns = columns_old).reindex(
+                                      index = columns, columns = columns, fill_value = 0).to_numpy()
+                votings = votings.append(new_votings.index)
+
+                metadata = {'legislature': legislature, 
+                            'abstention_decision': par[0], 
+                            'obstruction_decision': par[1], 
+                            'agreement': par[2]}
+                self.save_pair_sums(numerator, denominator, votings, columns, name.format(legislature, par[0], par[1]), metadata)
+                self.save_adjacency_matrix(self.adjacency_from_sums(numerator, denominator, len(votings), columns), 
+                                           name.format(legislature, par[0], par[1]), metadata = metadata, **storage)
+                self.store_adjacency(legislature, par, storage)
+
+    @stage()
+    def build_temporal_adjacency(self, legislature, abstention_decision, obstruction_decision, agreement = False, 
+                                 window = 90, step = 7, dtype = np.float32): 
+        """
+        Adjacency matrices of a legislature over rolling windows of time. The
+        votings are sorted by date and the sums of `pair_sums` are
+        accumulated up to each window limit, so each window is the difference
+        of two accumulated sums and each voting is computed only once. The
+        stack (windows x deputies x deputies) is saved memory-mapped in
+        `graphs/temporal_adjacency_legislature_{legislature}_{abstention}_{obstruction}_{window}_{step}`
+        (see `matrix_storage.create_stack`), indexed by the first day of each
+        window. Windows without votings are NaN. 
+        - window (int): length of the windows in days. 
+        - step (int): days between the start of consecutive windows. 
+        - dtype: type of the saved matrices. 
+        """
+        incidence_matrix = self.import_incidence_matrix(legislature)
+
+        votes = pd.read_csv(os.path.join(self.data_root, 'tables/votes_info.csv'), usecols = ['id', 'year', 'month', 'day'], 
+                            dtype = {'id': str}, encoding = 'latin-1', index_col = 'id')
+        dates = pd.to_datetime(votes[['year', 'month', 'day']]).reindex(incidence_matrix.index)
+        dates = dates[dates.notna()].sort_values(kind = 'stable')
+        incidence_matrix = incidence_matrix.loc[dates.index]
+        columns = incidence_matrix.columns
+        m = len(columns)
+
+        starts = pd.date_range(dates.iloc[0], dates.iloc[-1], freq = pd.Timedelta(days = step))
+        ends = starts + pd.Timedelta(days = window)
+        cuts = sorted(set(starts) | set(ends))
+        positions = np.searchsorted(dates.to_numpy(), np.array(cuts, dtype = dates.dtype), side = 'left')
+
+        windows_start = {start: i for i, start in enumerate(starts)}
+        windows_end = {}
+        for i, end in enumerate(ends): 
+            windows_end.setdefault(end, []).append(i)
+
+        name = "temporal_adjacency_legislature_{}_{}_{}_{}_{}".format(legislature, abstention_decision, 
+                                                                      obstruction_decision, window, step)
+        stack = create_stack(os.path.join(self.data_root, 'graphs/{}'.format(name)), (len(starts), m, m), 
+                             index = [str(start.date()) for start in starts], columns = columns, 
+                             metadata = {'legislature': legislature, 
+                                         'abstention_decision': abstention_decision, 
+                                         'obstruction_decision': obstruction_decision, 
+                                         'agreement': agreement, 
+                                         'window': window, 
+                                         'step': step}, 
+                             dtype = dtype)
+
+        numerator = np.zeros((m, m))
+        denominator = np.zeros((m, m)) if abstention_decision == 'same' and agreement == True else None
+        previous = 0
+        states = {}
+
+        for cut, position in zip(cuts, positions): 
+
+            if position > previous: 
+                num, den = self.pair_sums(incidence_matrix.iloc[previous:position], abstention_decision, 
+                                          obstruction_decision, agreement)
+                numerator += num
+                if denominator is not None: 
+                    denominator += den
+                previous = position
+
+            if cut in windows_start: 
+                states[cut] = (numerator.copy(), None if denominator is None else denominator.copy(), position)
+
+            for i in windows_end.get(cut, []): 
+                numerator_start, denominator_start, position_start = states.pop(starts[i])
+                n = position - position_start
+                if n == 0: 
+                    stack[i] = np.nan
+                else: 
+                    stack[i] = self.adjacency_from_sums(numerator - numerator_start, 
+                                                        None if denominator is None else denominator - denominator_start, 
+                                                        n, columns).to_numpy()
+
+        stack.flush()
+        return name
+
+    def theme_indicator(self, votings): 
+        """
+        Sparse indicator matrix votings x themes, from the propositions of the
+        votings (`ultimaApresentacaoProposicao_idProposicao` of
+        `votes_info.csv`) and their themes (`propositions.csv`, see
+        `DataPreprocessing.get_propositions`). A voting can have many themes
+        or none. It returns the CSC matrix and the names of the themes,
+        indexed by their codes. 
+        - votings (list): voting ids of the rows. 
+        """
+        votes = pd.read_csv(os.path.join(self.data_root, 'tables/votes_info.csv'), usecols = ['id', 'ultimaApresentacaoProposicao_idProposicao'], 
+                            dtype = {'id': str}, encoding = 'latin-1')
+        votes = votes.dropna().astype({'ultimaApresentacaoProposicao_idProposicao': int})
+        propositions = pd.read_csv(os.path.join(self.data_root, 'tables/propositions.csv'), usecols = ['id', 'codTema', 'Tema']).dropna()
+
+        # The lists of codes and names are saved as their text. 
+        themes = pd.DataFrame([(proposition, code, theme) 
+                               for proposition, codes, names in zip(propositions.id, propositions.codTema, propositions.Tema) 
+                               for code, theme in zip(ast.literal_eval(codes), ast.literal_eval(names))], 
+                              columns = ['ultimaApresentacaoProposicao_idProposicao', 'codTema', 'Tema'])
+        votes = votes.merge(themes, on = 'ultimaApresentacaoProposicao_idProposicao')
+
+        rows = pd.Index(votings).astype(str).get_indexer(votes.id)
+        votes = votes[rows >= 0]
+        codes, theme_codes = pd.factorize(votes.codTema, sort = True)
+
+        indicator = sp.csc_matrix((np.ones(len(codes)), (rows[rows >= 0], codes)), shape = (len(votings), len(theme_codes)))
+        # A voting counts once in a theme, even if listed twice. 
+        indicator.data[:] = 1
+        return indicator, votes.groupby('codTema').Tema.first().reindex(theme_codes)
+
+    def theme_pair_sums(self, incidence_matrix, configurations, indicator): 
+        """
+        The `batch_pair_sums` of the votings of each theme, without building
+        an incidence matrix per theme. The raw votes are split in indicators
+        (and, for the 'strong' abstention, the majority of each voting is
+        taken) only once, and each product of `raw_counts` is restricted to
+        the votings of a column of the indicator. It yields, for each theme,
+        the number of its votings and the sums of the configurations. 
+        - indicator (csc_matrix): votings x themes (see `theme_indicator`). 
+        """
+        m = incidence_matrix.shape[1]
+        votes = incidence_matrix.to_numpy(dtype = float)
+        raw, cleaned = self.raw_votes(votes, configurations)
+        indicators = {value: 1.0*(votes == value) for value in raw}
+        strong = {(par[0], par[1]): self.clean_votes(incidence_matrix, par[0], par[1]) 
+                  for par in configurations if par[0] == 'strong'}
+
+        for theme in range(indicator.shape[1]): 
+            rows = indicator.indices[indicator.indptr[theme]:indicator.indptr[theme + 1]]
+            counts = self.raw_counts({value: votes_value[rows] for value, votes_value in indicators.items()})
+
+            sums = []
+            for abstention_decision, obstruction_decision, agreement in configurations: 
+                if abstention_decision == 'strong': 
+                    theme_votes = strong[abstention_decision, obstruction_decision][rows]
+                    sums.append((theme_votes.T @ theme_votes, None))
+                else: 
+                    sums.append(self.sums_from_counts(counts, cleaned[abstention_decision, obstruction_decision], 
+                                                      abstention_decision, agreement, m))
+            yield len(rows), sums
+
+    @stage()
+    def build_theme_adjacency(self, legislature, configurations, min_votings = 1, verify = True, dtype = np.float32): 
+        """
+        Adjacency matrices of a legislature for each theme of the propositions
+        (health, economy...), equal to the ones `build_adjacency_matrix`
+        builds from the votings of the theme only (so n is the number of
+        votings of the theme). A voting with many themes contributes to all
+        of them (see `theme_pair_sums`). For each configuration, the stack
+        (themes x deputies x deputies) is saved memory-mapped in
+        `graphs/theme_adjacency_legislature_{legislature}_{abstention}_{obstruction}`
+        (see `matrix_storage.create_stack`), indexed by the codes of the
+        themes, with their names and numbers of votings in the metadata. It
+        returns the names of the stacks. 
+        - configurations (list): tuples (abstention_decision,
+          obstruction_decision, agreement). 
+        - min_votings (int): themes with fewer votings are left out. 
+        - verify (bool): skip the configurations already built from the same
+          tables (see `ResultCache`). 
+        - dtype: type of the saved matrices. 
+        """
+        name = "theme_adjacency_legislature_{}_{}_{}"
+        names = [name.format(legislature, par[0], par[1]) for par in configurations]
+        inputs = self.incidence_files(legislature) + [os.path.join(self.data_root, 'tables/votes_info.csv'), os.path.join(self.data_root, 'tables/propositions.csv')]
+        parameters = [{'legislature': legislature, 'configuration': list(par), 'min_votings': min_votings, 
+                       'dtype': np.dtype(dtype).name} for par in configurations]
+        keys = [self.cache.key(inputs, parameter) for parameter in parameters]
+
+        stale = [i for i in range(len(configurations)) if not (verify and self.cache.fresh(names[i], keys[i]))]
+        if len(stale) == 0: 
+            return names
+
+        incidence_matrix = self.import_incidence_matrix(legislature)
+        indicator, themes = self.theme_indicator(incidence_matrix.index)
+        votings = np.diff(indicator.indptr)
+        kept = np.flatnonzero(votings >= min_votings)
+        indicator, themes, votings = indicator[:, kept], themes.iloc[kept], votings[kept]
+        columns = incidence_matrix.columns
+        m = len(columns)
+        record(rows_in = incidence_matrix.shape[0], themes = len(kept))
+
+        stacks = []
+        for i in stale: 
+            abstention_decision, obstruction_decision, agreement = configurations[i]
+            stacks.append(create_stack(os.path.join(self.data_root, 'graphs/{}'.format(names[i])), (len(kept), m, m), 
+                                       index = themes.index, columns = columns, 
+                                       metadata = {'legislature': legislature, 
+                                                   'abstention_decision': abstention_decision, 
+                                                   'obstruction_decision': obstruction_decision, 
+                                                   'agreement': agreement, 
+                                                   'themes': list(themes), 
+                                                   'votings': votings.tolist()}, 
+                                       dtype = dtype))
+
+        for theme, (n, sums) in enumerate(self.theme_pair_sums(incidence_matrix, [configurations[i] for i in stale], indicator)): 
+            for stack, (numerator, denominator) in zip(stacks, sums): 
+                stack[theme] = self.adjacency_from_sums(numerator, denominator, n, columns).to_numpy()
+
+        for i, stack in zip(stale, stacks): 
+            stack.flush()
+            file_name = os.path.join(self.data_root, 'graphs/{}'.format(names[i]))
+            self.cache.store(names[i], keys[i], [file_name + '.npy', file_name + '.npz'], parameters[i], group = 'adjacency')
+
+        if self.cache_bytes is not None: 
+            self.cache.evict('adjacency', max_bytes = self.cache_bytes)
+
+        return names
+
+    def import_theme_adjacency(self, legislature, abstention_decision, obstruction_decision, theme = None): 
+        """
+        Import the stack of `build_theme_adjacency` (the memory-mapped array,
+        the codes of the themes, the deputies and the metadata) or, given the
+        code of a theme, its adjacency matrix as a DataFrame. 
+        """
+        name = "theme_adjacency_legislature_{}_{}_{}".format(legislature, abstention_decision, obstruction_decision)
+        self.cache.touch(name)
+        stack, themes, columns, metadata = load_stack(os.path.join(self.data_root, 'graphs/{}'.format(name)))
+
+        if theme is None: 
+            return stack, themes, columns, metadata
+        position = np.flatnonzero(themes == theme)
+        if len(position) == 0: 
+            raise Exception('The theme {} has no adjacency matrix in the legislature {}'.format(theme, legislature))
+        return pd.DataFrame(np.asarray(stack[position[0]]), index = columns, columns = columns)
+
+    def front_incidence(self, legislature, coordinator_weight = 1): 
+        """
+        Sparse incidence matrix deputies x fronts of a legislature, from
+        `fronts.csv` (see `DataPreprocessing.get_fronts`). The entries are 1
+        for the members and coordinator_weight for the coordinators. It
+        returns the CSR matrix, the deputies and the fronts. 
+        """
+        fronts = pd.read_csv(os.path.join(self.data_root, 'tables/fronts.csv'), index_col = 0)
+        fronts = fronts[(fronts.legislatura == legislature) & (fronts.id_deputado != 0)]
+        fronts = fronts.groupby(['id_deputado', 'id_front']).coordenador.max().reset_index()
+
+        deputies, deputy_ids = pd.factorize(fronts.id_deputado, sort = True)
+        front_codes, front_ids = pd.factorize(fronts.id_front, sort = True)
+        weights = np.where(fronts.coordenador == 1, coordinator_weight, 1.0)
+
+        incidence = sp.csr_matrix((weights, (deputies, front_codes)), shape = (len(deputy_ids), len(front_ids)))
+        return incidence, deputy_ids.astype(int), front_ids
 
+    @stage()
+    def build_front_adjacency(self, legislature, normalization = None, coordinator_weight = 1, deputies = None, 
+                              verify = True): 
+        """
+        Adjacency matrix of the co-membership of the deputies of a legislature
+        in the parliamentary fronts, computed with a single sparse product
+        B B^T of the deputies x fronts incidence matrix B (see
+        `front_incidence`). It is saved as a `SparseMatrix` (the format of the
+        sparse voting adjacency matrices, see `save_adjacency_matrix`), where
+        the missing entries are 0, and it returns its name. 
+        - normalization (str): 
+            - None: (weighted) number of common fronts. 
+            - 'fronts': divided by the number of fronts, as the voting
+              adjacency is divided by the number of votings. 
+            - 'cosine': divided by the square root of the diagonal entries of
+              both deputies (the diagonal becomes 1). 
+            - 'jaccard': common fronts over the fronts of either deputy. 
+            - 'newman': each front adds 1/(size - 1) to each pair of its
+              members, so the large fronts weigh less. 
+        - coordinator_weight (float): weight of the coordinators (1 treats
+          them as the other members). 
+        - deputies (list): deputy ids of the rows and columns, such as the
+          columns of the voting adjacency matrix, so both layers are aligned.
+          The deputies without fronts have empty rows. The default is the
+          deputies in some front. 
+        - verify (bool): skip when it was already built from the same table
+          (see `ResultCache`). 
+        """
+        if normalization not in [None, 'fronts', 'cosine', 'jaccard', 'newman']: 
+            raise Exception('The normalization {} was not programmed'.format(normalization))
+
+        name = "front_adjacency_legislature_{}_{}_{}".format(legislature, normalization, coordinator_weight)
+        parameters = {'legislature': legislature, 'normalization': normalization, 'coordinator_weight': coordinator_weight, 
+                      'deputies': None if deputies is None else [int(i) for i in deputies]}
+        key = self.cache.key([os.path.join(self.data_root, 'tables/fronts.csv')], parameters)
+        if verify and self.cache.fresh(name, key): 
+            return name
+
+        incidence, deputy_ids, front_ids = self.front_incidence(legislature, coordinator_weight)
+        number_fronts = incidence.shape[1]
+        record(rows_in = incidence.nnz)
+
+        if normalization == 'newman': 
+            # Each side of the product gets the square root of the weight. 
+            size = np.diff(incidence.tocsc().indptr)
+            incidence = incidence @ sp.diags(np.sqrt(np.divide(1.0, size - 1, out = np.zeros(len(size)), where = size > 1)))
+
+        if deputies is not None: 
+            # Rows of the given deputies (empty for the ones without fronts). 
+            positions = pd.Index(deputy_ids).get_indexer(pd.Index(deputies).astype(int))
+            found = np.flatnonzero(positions >= 0)
+            selection = sp.csr_matrix((np.ones(len(found)), (found, positions[found])), shape = (len(positions), len(deputy_ids)))
+            incidence = selection @ incidence
+            deputy_ids = np.asarray(deputies).astype(int)
+
+        adj = (incidence @ incidence.T).tocsr()
+
+        if normalization == 'fronts': 
+            adj = adj/max(number_fronts, 1)
+        elif normalization == 'cosine' or normalization == 'jaccard': 
+            diagonal = adj.diagonal()
+            coo = adj.tocoo()
+            if normalization == 'cosine': 
+                data = coo.data/np.sqrt(diagonal[coo.row]*diagonal[coo.col])
+            else: 
+                data = coo.data/(diagonal[coo.row] + diagonal[coo.col] - coo.data)
+            adj = sp.csr_matrix((data, (coo.row, coo.col)), shape = adj.shape)
+
+        metadata = {key: value for key, value in parameters.items() if key != 'deputies'}
+        metadata['fronts'] = number_fronts
+        save_csr_matrix(adj, deputy_ids, deputy_ids, os.path.join(self.data_root, 'graphs/{}'.format(name)), metadata = metadata, exact_above = 0.0)
+        self.cache.store(name, key, [os.path.join(self.data_root, 'graphs/{}.npy'.format(name)), os.path.join(self.data_root, 'graphs/{}.npz'.format(name))], 
+                         parameters, group = 'adjacency')
+        record(rows_out = adj.nnz)
+
+        return name
+
+    def import_front_adjacency(self, legislature, normalization = None, coordinator_weight = 1): 
+        """
+        Import the co-membership adjacency matrix of `build_front_adjacency`
+        as a `SparseMatrix`. 
+        """
+        name = "front_adjacency_legislature_{}_{}_{}".format(legislature, normalization, coordinator_weight)
+        self.cache.touch(name)
+        return load_matrix(os.path.join(self.data_root, 'graphs/{}'.format(name)))
+
+    def save_pair_sums(self, numerator, denominator, votings, columns, name, metadata = None): 
+        """
+        Save the sums of `pair_sums` over the votings in `graphs/sums/` of the
+        data folder.
+        The ids of the votings are saved in the metadata. 
+        """
+        metadata = dict(metadata if metadata is not None else {}, n = len(votings), 
+                        votings = [str(voting) for voting in votings], denominator = denominator is not None)
+        save_matrix(pd.DataFrame(numerator, index = columns, columns = columns), 
+                    os.path.join(self.data_root, 'graphs/sums/{}_numerator'.format(name)), metadata = metadata)
+        if denominator is not None: 
+            save_matrix(pd.DataFrame(denominator, index = columns, columns = columns), 
+                        os.path.join(self.data_root, 'graphs/sums/{}_denominator'.format(name)), metadata = metadata)
+
+    def import_pair_sums(self, name): 
+        """
+        Import the sums saved with `save_pair_sums`. It returns the
+        numerator, the denominator (or None), the ids of the votings (None
+        for the sums saved without them) and the deputies. 
+        """
+        numerator = load_matrix(os.path.join(self.data_root, 'graphs/sums/{}_numerator'.format(name)), mmap = False)
+        denominator = None
+        if numerator.attrs['denominator']: 
+            denominator = load_matrix(os.path.join(self.data_root, 'graphs/sums/{}_denominator'.format(name)), mmap = False).to_numpy()
+        votings = numerator.attrs.get('votings')
+        votings = pd.Index(votings, dtype = object) if votings is not None else None
+        return numerator.to_numpy(), denominator, votings, numerator.columns
+
+    def vote_indicators(self, votes): 
+        """
+        Indicator matrices for each non-zero value of the votes array, that
+        is, a dictionary value -> (votes == value) as float arrays. 
+        """
+        return {value: 1.0*(votes == value) for value in np.unique(votes) if value != 0}
+
+    def equal_votes(self, indicators, m): 
+        """
+        Number of votings where each pair of the m deputies voted the same
+        non-zero value. 
+        """
+        equal = np.zeros((m, m))
+        for indicator in indicators.values(): 
+            equal += indicator.T @ indicator
+        return equal
+
+    def opposite_votes(self, indicators, m): 
+        """
+        Number of votings where each pair of the m deputies voted opposite
+        non-zero values (value and -value). 
+        """
+        opposite = np.zeros((m, m))
+        for value, indicator in indicators.items(): 
+            if -value in indicators: 
+                opposite += indicator.T @ indicators[-value]
+        return opposite
+
+    @stage()
     def build_graph_threshold(self, adjacency_matrix, threshold, legislature = None): 
+        """
+        Graph with the links of the adjacency matrix above the threshold. 
+        - adjacency_matrix (DataFrame, SparseMatrix or ThresholdSweep): when
+          exploring many thresholds, pass a `ThresholdSweep` of the matrix,
+          which is built once and avoids comparing the whole matrix each time.
+          A `SparseMatrix` is used without making it dense. 
+        - threshold (float): minimum weight (exclusive) of a link. 
+        - legislature (int): if given, the deputies' information is added. 
+        """
+        # networkx is only imported by the stages that build graphs. 
+        import networkx as nx
 
-        adj = 1*(adjacency_matrix > threshold)
-        G = nx.from_pandas_adjacency(df = adj)
+        if isinstance(adjacency_matrix, SparseMatrix): 
+            adjacency_matrix = ThresholdSweep(adjacency_matrix)
+
+        if isinstance(adjacency_matrix, ThresholdSweep): 
+            G = adjacency_matrix.graph(threshold)
+        else: 
+            adj = 1*(adjacency_matrix > threshold)
+            G = nx.from_pandas_adjacency(df = adj)
 
         if legislature is not None: 
             G = self.deputies_info(G, legislature)
 
+        record(rows_out = G.number_of_edges())
         return G
 
-    def deputies_info(self, graph, legislature): 
+    def deputies_store(self): 
+        """
+        The deputies' attributes (see `DeputiesStore`), loaded in the first
+        call only. 
+        """
+        if self.deputies is None: 
+            self.deputies = DeputiesStore(data_root = self.data_root)
+        return self.deputies
 
-        deputies = pd.read_csv('../data/tables/deputies.csv', index_col = 0)
+    def deputies_info(self, graph, legislature): 
+        """
+        Add the party, state, region and name of the deputies of a
+        legislature to the nodes of the graph. 
+        """
+        import networkx as nx
 
-        parties = dict(zip(deputies[deputies.idLegislatura==legislature].id.astype(int), 
-                           deputies[deputies.idLegislatura==legislature].siglaPartido))
-        uf = dict(zip(deputies[deputies.idLegislatura==legislature].id.astype(int), 
-                      deputies[deputies.idLegislatura==legislature].siglaUf))
-        region = dict(zip(deputies[deputies.idLegislatura==legislature].id.astype(int), 
-                          deputies[deputies.idLegislatura==legislature].region))
-        names = dict(zip(deputies[deputies.idLegislatura==legislature].id.astype(int), 
-                         deputies[deputies.idLegislatura==legislature].nome))
+        table = self.deputies_store().table(legislature, list(graph.nodes))
 
-        nx.set_node_attributes(graph, parties, 'party')
-        nx.set_node_attributes(graph, uf, 'uf')
-        nx.set_node_attributes(graph, region, 'region')
-        nx.set_node_attributes(graph, names, 'names')
+        for attribute, name in [('siglaPartido', 'party'), ('siglaUf', 'uf'), ('region', 'region'), ('nome', 'names')]: 
+            nx.set_node_attributes(graph, table[attribute].dropna().to_dict(), name)
 
         return graph
 
 if __name__ == '__main__': 
 
-    graphConstrutor = GraphConstruction()
+    import sys
+    from pipeline import main
 
-    parameters = [('partial-unknown', 'against', False), 
-                    ('same', 'same', True)
-                    ]
-
-    print("INFO - You can change the parameters of the graph constructor in the script file!")
+    print("INFO - You can change the parameters of the graph constructor with `PipelineRunner.configurations`!")
     print('INFO - These were used by the project. ')
-    
-    print("QUESTION - Do you want to verify if the file were already generated?")
-    while True: 
-        ans = input("[y/n]")
-        if ans == 'y': 
-            verify = True
-            break
-        elif ans == 'n':
-            verify = False
-            break
-        else: 
-            continue
-
-    print("INFO - This procedure can take about 30 minutes!")
-
-    for legislature in trange(52,57,desc='Legislature'): 
-
-        incidence_matrix = graphConstrutor.import_incidence_matrix(legislature)
-    
-        for par in parameters: 
-
-            if verify: 
-                if os.path.exists("adjacency_matrix_legislature_{}_{}_{}".format(legislature, par[0], par[1])): 
-                    continue
 
-            adjacency_matrix = graphConstrutor.build_adjacency_matrix(incidence_matrix, 
-                                                                    abstention_decision = par[0],
-                                                                    obstruction_decision = par[1],
-                                                                    agreement = par[2])
-                                                                
-            graphConstrutor.save_adjacency_matrix(adjacency_matrix, 
-                                                "adjacency_matrix_legislature_{}_{}_{}".format(legislature, par[0], par[1]))
-                                                
-    print("INFO - The adjacency matrices were generated!")
\ No newline at end of file
+    # The matrices already built from the same incidence matrices are
+    # skipped, unless --force is given (see `python pipeline.py --help`). 
+    sys.exit(main(['--stages', 'adjacency'] + sys.argv[1:]))
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import pandas as pd
+import numpy as np
 import os 
 import requests 
 import re
@@ -8,8 +9,49 @@ import re
 import time
 from tqdm import trange, tqdm
 import json
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import shutil
+import threading
+import random
+import sqlite3
+
+# DadosAbertosBrasil is slow to import, so it is imported by the methods
+# that call the API only. 
+from matrix_storage import save_matrix, load_matrix, matrix_exists
+from instrumentation import stage, record
+from pipeline_cache import ResultCache
+
+class TokenBucket: 
+    """
+    Token bucket shared by threads to limit the rate of requests. 
+    """
 
-from DadosAbertosBrasil import camara
+    def __init__(self, rate, capacity = None) -> None: 
+        """
+        - rate (float): tokens added per second. 
+        - capacity (float): maximum number of tokens (burst size). The default
+          is the rate. 
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None: 
+        """
+        Wait until a token is available and take it. 
+        """
+        while True: 
+            with self.lock: 
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated)*self.rate)
+                self.updated = now
+                if self.tokens >= 1: 
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens)/self.rate
+            time.sleep(wait)
 
 class DataPreprocessing: 
     """
@@ -17,29 +59,33 @@ class DataPreprocessing:
     to the votes and deputies from the Brazil National Congress. 
     """
 
-    def __init__(self) -> None:
+    def __init__(self, data_root = '../data') -> None:
         """
         Init function. It creates all necessary folders. 
+        - data_root (str): folder of the data. The default is the `data`
+          folder of the repository, relative to `pyscripts`. 
         """
 
+        self.data_root = data_root
         self.api_website = 'https://dadosabertos.camara.leg.br/api/v2/'
         self.archive_website = 'http://dadosabertos.camara.leg.br/arquivos/'
 
         self.data_folder()
+        self.cache = ResultCache(data_root = data_root)
 
     def data_folder(self) -> None: 
         """
         Create the data folder structure. 
         """
 
-        if not os.path.exists('../data/'):
-            os.mkdir('../data/')
+        if not os.path.exists(self.data_root):
+            os.makedirs(self.data_root)
 
-        if not os.path.exists('../data/raw/'): 
-            os.mkdir('../data/raw/') 
+        if not os.path.exists(os.path.join(self.data_root, 'raw')): 
+            os.mkdir(os.path.join(self.data_root, 'raw')) 
 
-        if not os.path.exists('../data/tables/'): 
-            os.mkdir('../data/tables/') 
+        if not os.path.exists(os.path.join(self.data_root, 'tables')): 
+            os.mkdir(os.path.join(self.data_root, 'tables')) 
 
     def download_votes_api(self, year1 = 1995, year2 = 2021) -> None: 
         """
@@ -49,9 +95,11 @@ class DataPreprocessing:
         - year1: MMMM with staring year from 1990 to 2021. 
         - year2: MMMM with ending year from 1990 to 2021. 
         """
+        from DadosAbertosBrasil import camara
+
         print("WARNING - This function takes to long!")
 
-        votes = pd.DataFrame()
+        votes = []
 
         with trange(year1, year2+1, desc='Year') as years: 
             
@@ -73,72 +121,152 @@ class DataPreprocessing:
                         except: 
                             time.sleep(10)
                 
-                    votes = votes.append(vot.reset_index(drop=True))
+                    votes.append(vot.reset_index(drop=True))
             
+        votes = pd.concat(votes)
         votes.to_csv('../dados/raw/votacoes_api.csv')
 
 
-    def download_necessary_files(self, year1 = 1995, year2 = 2021) -> None: 
+    @stage()
+    def download_necessary_files(self, year1 = 1995, year2 = 2021, workers = 8, refresh = False) -> None: 
         """
         This function downloads all the necessary raw data. It includes the
-        voting ids from year1 to year2 and the deputies' voting pattern.  
+        voting ids from year1 to year2 and the deputies' voting pattern. The
+        files are downloaded concurrently (see `download_file`).  
         - year1: MMMM with staring year from 1990 to 2021. 
         - year2: MMMM with ending year from 1990 to 2021. 
+        - workers (int): maximum number of simultaneous downloads. 
+        - refresh (bool): if true, the files already downloaded are fetched
+          again only if they changed in the server. 
         """
-        print("MESSAGE - Starting to download the voting informations.")
-
-        for year in trange(year1, year2 + 1, desc='Year'): 
-            filepath = '../data/raw/votacoes-{}.csv'.format(year)
-            if os.path.exists(filepath): 
-                continue
-            else: 
-                page = requests.get(self.archive_website+'votacoes/csv/votacoes-{}.csv'.format(year))
-                with open(filepath, 'w') as f: 
-                    f.write(page.text)
-
-        print("MESSAGE - Starting to download the the voting pattern for the deputies. ")
+        print("MESSAGE - Starting to download the voting informations and the voting pattern for the deputies.")
 
-        for year in trange(year1, year2 + 1, desc='Year'): 
-            filepath = '../data/raw/votacoesVotos-{}.csv'.format(year)
-            if os.path.exists(filepath): 
-                continue
-            else: 
-                page = requests.get(self.archive_website+'votacoesVotos/csv/votacoesVotos-{}.csv'.format(year))
-                with open(filepath, 'w') as f: 
-                    f.write(page.text)
+        files = []
+        for year in range(year1, year2 + 1): 
+            files.append(('votacoes/csv/votacoes-{}.csv'.format(year), 
+                          os.path.join(self.data_root, 'raw/votacoes-{}.csv'.format(year))))
+            files.append(('votacoesVotos/csv/votacoesVotos-{}.csv'.format(year), 
+                          os.path.join(self.data_root, 'raw/votacoesVotos-{}.csv'.format(year))))
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        with session, ThreadPoolExecutor(max_workers=workers) as executor: 
+            downloads = [executor.submit(self.download_file, session, self.archive_website + url, filepath, refresh) 
+                         for url, filepath in files]
+            for download in tqdm(as_completed(downloads), total=len(downloads), desc='File'): 
+                download.result()
 
         print('MESSAGE - The download concluded!')
 
-    def get_deputies(self, l1 = 52, l2 = 56, verify = True) -> None: 
+    def download_file(self, session, url, filepath, refresh = False, chunk_size = 2**20) -> None: 
+        """
+        Download url to filepath. The content is streamed to `filepath.part`
+        and renamed at the end, so an existing filepath is always complete.
+        An interrupted download is resumed with an HTTP Range request. The
+        ETag and Last-Modified headers are kept in `filepath.meta` and used
+        to fetch again only if the file changed. 
+        - session (requests.Session): session used for the requests. 
+        - url (str): address of the file. 
+        - filepath (str): where the file is saved. 
+        - refresh (bool): if false, an existing file is not fetched again. 
+        """
+        partpath = filepath + '.part'
+        metapath = filepath + '.meta'
+
+        if os.path.exists(filepath) and not refresh: 
+            return
+
+        meta = {}
+        if os.path.exists(metapath): 
+            with open(metapath) as f: 
+                meta = json.load(f)
+
+        headers = {}
+        if os.path.exists(filepath): 
+            if 'etag' in meta: 
+                headers['If-None-Match'] = meta['etag']
+            if 'last_modified' in meta: 
+                headers['If-Modified-Since'] = meta['last_modified']
+        elif os.path.exists(partpath) and meta.get('partial', False): 
+            headers['Range'] = 'bytes={}-'.format(os.path.getsize(partpath))
+            if 'etag' in meta or 'last_modified' in meta: 
+                headers['If-Range'] = meta.get('etag', meta.get('last_modified'))
+
+        with session.get(url, headers=headers, stream=True, timeout=60) as response: 
+
+            if response.status_code == 304: 
+                return
+            if response.status_code == 416: 
+                # The range was not satisfiable, so the partial file is dropped. 
+                os.remove(partpath)
+                os.remove(metapath)
+                return self.download_file(session, url, filepath, refresh, chunk_size)
+            response.raise_for_status()
+
+            meta = {'partial': True}
+            if 'ETag' in response.headers: 
+                meta['etag'] = response.headers['ETag']
+            if 'Last-Modified' in response.headers: 
+                meta['last_modified'] = response.headers['Last-Modified']
+            with open(metapath, 'w') as f: 
+                json.dump(meta, f)
+
+            mode = 'ab' if response.status_code == 206 else 'wb'
+            with open(partpath, mode) as f: 
+                for chunk in response.iter_content(chunk_size=chunk_size): 
+                    f.write(chunk)
+
+        os.replace(partpath, filepath)
+
+        meta['partial'] = False
+        with open(metapath, 'w') as f: 
+            json.dump(meta, f)
+
+    @stage()
+    def get_deputies(self, l1 = 52, l2 = 56, verify = True, max_retries = 8) -> None: 
         """
         This function gets the information of the deputies from legislature l1
         to l2. It saves the id, uri, party, state, region, name, and
         legislature. 
         - l1 (int): Starting legislature. 
         - l2 (int): Ending legislature. 
-        - verify (bool): verify if the file already exists. If true, the
-          function does not do anything.  
+        - verify (bool): verify if the file was already generated with the
+          same legislatures (see `ResultCache`). If true, the function does
+          not do anything.  
+        - max_retries (int): number of attempts of each legislature when the
+          API fails (the other errors are raised at once). 
         """
+        from DadosAbertosBrasil import camara
+
         print('MESSAGE - Starting to download the deputies.')
 
+        parameters = {'legislatures': [l1, l2]}
+        key = self.cache.key(parameters=parameters)
         if verify: 
-            if os.path.exists('../data/tables/deputies.csv'): 
+            if self.cache.fresh('deputies', key): 
                 print('MESSAGE - The file already exists.')
                 return
 
-        deputies = pd.DataFrame() 
+        deputies = []
         information = ['id', 'uri', 'nome', 'siglaPartido', 'siglaUf', 'idLegislatura']
 
         for leg in trange(l1, l2+1, desc='Legislature'):
-            while True: 
+            for attempt in range(max_retries): 
                 try: 
-                    deputies = deputies.append(camara.lista_deputados(legislatura=leg)[information].reset_index(drop=True))
+                    deputies.append(camara.lista_deputados(legislatura=leg)[information].reset_index(drop=True))
                     break
-                except Exception as e:
+                except (requests.exceptions.RequestException, json.JSONDecodeError) as e:
+                    if attempt == max_retries - 1: 
+                        raise Exception("ERROR - The deputies of the legislature {} could not be fetched.".format(leg)) from e
                     print(e) 
-                    print("ESSAGE - Trying after 10 seconds...")
+                    print("MESSAGE - Trying after 10 seconds...")
                     time.sleep(10)
 
+        deputies = pd.concat(deputies)
+
         regions = {'RR': 'Norte', 'AP': 'Norte', 'AM': 'Norte', 'PA': 'Norte', 'AC': 'Norte', 
                    'RO': 'Norte', 'TO': 'Norte', 'MA': 'Nordeste', 'PI': 'Nordeste', 'CE': 'Nordeste', 
                    'RN': 'Nordeste', 'PB': 'Nordeste', 'PE': 'Nordeste', 'AL': 'Nordeste', 'SE': 'Nordeste', 
@@ -148,133 +276,245 @@ class DataPreprocessing:
 
         deputies['region'] = deputies.siglaUf.apply(lambda x: regions[x])
 
-        deputies.to_csv('../data/tables/deputies.csv')
+        deputies.to_csv(os.path.join(self.data_root, 'tables/deputies.csv'))
+        self.cache.store('deputies', key, [os.path.join(self.data_root, 'tables/deputies.csv')], parameters)
 
         print('MESSAGE - The download is concluded.')
 
-    def prepare_votes_table(self, year1 = 2003, year2 = 2021, verify = True) -> None: 
+    @stage()
+    def prepare_votes_table(self, year1 = 2003, year2 = 2021, verify = True, workers = None, chunksize = 200000) -> None: 
         """
         Get the important information from the voting files and generate the voting
         tables relating to the ids. We gatter all the voting and filter by
-        that which have votes computed. 
+        that which have votes computed. Each year is ingested by a different
+        process (see `ingest_year`) in chunks, so the memory does not grow
+        with the number of years. 
         - year1: MMMM with staring year from 1990 to 2021. 
         - year2: MMMM with ending year from 1990 to 2021. 
+        - workers (int): number of processes. The default is the number of
+          cores. 
+        - chunksize (int): number of rows of the votes file read at once. 
+        - verify (bool): skip when the tables were already generated from
+          the same raw files (see `ResultCache`). 
         """
 
         print("MESSAGE - Stating to prepare the voting tables.")
 
+        key = self.votes_tables_key(year1, year2)
         if verify: 
-            if os.path.exists('../data/tables/votes_deputies.csv'): 
-                if os.path.exists('../data/tables/votes_info.csv'): 
-                    print('MESSAGE - The file already exists.')
-                    return
+            if self.cache.fresh('votes_tables', key): 
+                print('MESSAGE - The file already exists.')
                 return
 
-        info_votes = ['data', 'siglaOrgao', 'aprovacao', 'votosSim', 'votosNao', 'votosOutros', 
-                      'ultimaApresentacaoProposicao_idProposicao']
+        if not os.path.exists(os.path.join(self.data_root, 'tables/votes')): 
+            os.mkdir(os.path.join(self.data_root, 'tables/votes'))
+
+        years = list(range(year1, year2 + 1))
+        with ProcessPoolExecutor(max_workers=workers) as executor: 
+            list(tqdm(executor.map(self.ingest_year, years, [chunksize]*len(years)), total=len(years), desc='Year'))
+
+        # Concatenating the partitions without loading them (nor decoding
+        # them, so the tables keep the latin-1 of the partitions). 
+        for table in ['votes_info', 'votes_deputies']: 
+            with open(os.path.join(self.data_root, 'tables/{}.csv'.format(table)), 'wb') as output: 
+                for i, year in enumerate(years): 
+                    with open(os.path.join(self.data_root, 'tables/votes/{}-{}.csv'.format(table, year)), 'rb') as partition: 
+                        header = partition.readline()
+                        if i == 0: 
+                            output.write(header)
+                        shutil.copyfileobj(partition, output)
+
+        self.cache.store('votes_tables', key, [os.path.join(self.data_root, 'tables/votes_info.csv'), os.path.join(self.data_root, 'tables/votes_deputies.csv')], 
+                         {'years': [year1, year2]})
         
-        votes = pd.DataFrame()
-        for year in range(year1, year2 + 1): 
-            votes = votes.append(pd.read_csv('../data/raw/votacoes-{}.csv'.format(year), 
-                                              sep = ';', 
-                                              index_col=0, encoding='latin-1')[info_votes])
+        print("MESSAGE - Voting tables finished!")
+
+    def votes_tables_key(self, year1, year2) -> str: 
+        """
+        Cache key of the voting tables: the raw files of the years. 
+        """
+        raw_files = [os.path.join(self.data_root, 'raw/{}-{}.csv'.format(name, year)) 
+                     for year in range(year1, year2 + 1) for name in ['votacoes', 'votacoesVotos']]
+        return self.cache.key(raw_files, {'years': [year1, year2]})
 
+    @stage()
+    def ingest_year(self, year, chunksize = 200000) -> None: 
+        """
+        Prepare the voting tables of a year. Only the needed columns are read,
+        with compact types, and the votes file is read in chunks appended to
+        the partition `tables/votes/votes_deputies-{year}.csv` of the data
+        folder. The votings with votes computed are saved in
+        `tables/votes/votes_info-{year}.csv`. The partitions are
+        saved in latin-1, the encoding of the raw files, which is the one
+        every reader of the voting tables uses. 
+        - year: MMMM from 1990 to 2021. 
+        - chunksize (int): number of rows of the votes file read at once. 
+        """
         info_deputies = ['idVotacao', 'voto', 'deputado_id']
 
-        votes_deputies = pd.DataFrame() 
-        for year in range(year1, year2 + 1): 
-            votes_deputies = votes_deputies.append(pd.read_csv('../data/raw/votacoesVotos-{}.csv'.format(year), 
-                                                               sep = ';', encoding='latin-1')[info_deputies])
-        votes_deputies = votes_deputies.reset_index(drop=True)
+        voting_ids = []
+        partition = os.path.join(self.data_root, 'tables/votes/votes_deputies-{}.csv'.format(year))
+        chunks = pd.read_csv(os.path.join(self.data_root, 'raw/votacoesVotos-{}.csv'.format(year)), 
+                             sep = ';', encoding='latin-1', usecols=info_deputies, 
+                             dtype={'idVotacao': str, 'voto': 'category', 'deputado_id': 'Int64'}, 
+                             chunksize=chunksize)
 
-        votes = votes.loc[votes_deputies.idVotacao.unique()]
+        with open(partition, 'w', encoding='latin-1') as f: 
+            for i, votes_deputies in enumerate(chunks): 
+
+                # Fixing nan values 
+                voto = votes_deputies.voto
+                if 'Secreto' not in voto.cat.categories: 
+                    voto = voto.cat.add_categories('Secreto')
+                votes_deputies['voto'] = voto.fillna('Secreto')
+
+                votes_deputies[info_deputies].to_csv(f, index=False, header=(i == 0))
+                record(rows_in=votes_deputies.shape[0], rows_out=votes_deputies.shape[0])
+                voting_ids.append(votes_deputies.idVotacao.unique())
+
+        voting_ids = pd.unique(np.concatenate(voting_ids)) if len(voting_ids) > 0 else []
+
+        info_votes = ['data', 'siglaOrgao', 'aprovacao', 'votosSim', 'votosNao', 'votosOutros', 
+                      'ultimaApresentacaoProposicao_idProposicao']
+
+        votes = pd.read_csv(os.path.join(self.data_root, 'raw/votacoes-{}.csv'.format(year)), 
+                            sep = ';', encoding='latin-1', usecols=['id'] + info_votes, 
+                            dtype={'id': str, 'siglaOrgao': 'category'}, 
+                            index_col='id')[info_votes]
+        votes = votes.loc[voting_ids]
+        record(votings=votes.shape[0])
 
         # Separating year, month, and day from date 
-        votes['data'] = pd.to_datetime(votes['data'])
-        votes['year'] = votes['data'].apply(lambda x: x.year)
-        votes['month'] = votes['data'].apply(lambda x: x.month)
-        votes['day'] = votes['data'].apply(lambda x: x.day)
+        data = pd.to_datetime(votes.pop('data'))
+        votes['year'] = data.dt.year
+        votes['month'] = data.dt.month
+        votes['day'] = data.dt.day
 
         # Adding legislature
-        def legislature_calc(row): 
-            year = (row.year - 2003)
-            return year//4 + 52 - ((row.month == 1)&(year%4==0))
-        votes['legislature'] = votes.apply(legislature_calc, axis=1)
-
-        votes.drop(columns='data').to_csv('../data/tables/votes_info.csv')
+        year_shift = votes.year - 2003
+        votes['legislature'] = year_shift//4 + 52 - ((votes.month == 1)&(year_shift%4 == 0))
 
-        # Fixing nan values 
-        votes_deputies.voto = votes_deputies.voto.fillna('Secreto')
-        
-        votes_deputies.to_csv('../data/tables/votes_deputies.csv', index=False)
-        
-        print("MESSAGE - Voting tables finished!")
+        votes.to_csv(os.path.join(self.data_root, 'tables/votes/votes_info-{}.csv'.format(year)), encoding='latin-1')
 
-    def get_propositions(self) -> None: 
+    @stage()
+    def get_propositions(self, workers = 8, rate = 10, max_retries = 8) -> None: 
         """
-        Get the topics and types of the propositions related to the votes. 
+        Get the topics and types of the propositions related to the votes.
+        The propositions are fetched by a pool of workers and each result is
+        saved as soon as it arrives in a SQLite cache keyed by the
+        proposition id. Therefore, an interrupted run loses nothing and a new
+        run only fetches the propositions not seen yet. 
+        - workers (int): maximum number of simultaneous requests. 
+        - rate (float): maximum number of requests per second. 
+        - max_retries (int): number of attempts before giving up a
+          proposition (it is tried again in the next run). 
         """
         print("WARNING - The propositions table is still being developed...")
 
-        propositions = {'id': [], 'siglaTipo': [], 'codTema': [], 'Tema': []}
-        votes = pd.read_csv('../data/tables/votes_info.csv', encoding='latin-1')
-
-        for proposition in tqdm(votes.ultimaApresentacaoProposicao_idProposicao.unique()):
-                
-            error = False
-            while True: 
-                try:   
-                    prop = camara.Proposicao(cod=proposition)
-                    break
-                except KeyError: 
-                    error = True
-                    break
-                except:
-                    time.sleep(5)
-                        
-            if error: 
-                propositions['id'].append(proposition)
-                propositions['siglaTipo'].append(None)
-                propositions['codTema'].append(None)
-                propositions['Tema'].append(None)
-            else:
-                propositions['id'].append(proposition)
-                propositions['siglaTipo'].append(prop.tipo_sigla)
-
-                tema = prop.temas() 
-                if tema.shape[0] > 0: 
-                    propositions['codTema'].append(list(tema.codTema))
-                    propositions['Tema'].append(list(tema.tema))
-                else: 
-                    propositions['codTema'].append(None)
-                    propositions['Tema'].append(None)
-
-        pd.DataFrame(propositions).to_csv("../data/tables/propositions.csv", index=False) 
+        votes = pd.read_csv(os.path.join(self.data_root, 'tables/votes_info.csv'), encoding='latin-1')
+        ids = [int(p) for p in votes.ultimaApresentacaoProposicao_idProposicao.dropna().unique()]
+
+        cache = sqlite3.connect(os.path.join(self.data_root, 'tables/propositions.sqlite'))
+        cache.execute("""CREATE TABLE IF NOT EXISTS propositions 
+                         (id INTEGER PRIMARY KEY, siglaTipo TEXT, codTema TEXT, Tema TEXT)""")
+        seen = {row[0] for row in cache.execute("SELECT id FROM propositions")}
+        pending = [p for p in ids if p not in seen]
+
+        print("MESSAGE - {} propositions in the cache and {} to fetch.".format(len(ids) - len(pending), len(pending)))
+
+        bucket = TokenBucket(rate)
+        failures = 0
+
+        with ThreadPoolExecutor(max_workers=workers) as executor: 
+            fetches = [executor.submit(self.fetch_proposition, p, bucket, max_retries) for p in pending]
+            try: 
+                for fetch in tqdm(as_completed(fetches), total=len(fetches)): 
+                    try: 
+                        proposition, sigla, cod_tema, tema = fetch.result()
+                    except Exception as e: 
+                        print(e)
+                        failures += 1
+                        continue
+                    cache.execute("INSERT OR REPLACE INTO propositions VALUES (?, ?, ?, ?)", 
+                                  (proposition, sigla, json.dumps(cod_tema), json.dumps(tema)))
+                    cache.commit()
+            except BaseException: 
+                # An interruption (such as Ctrl-C) cancels the propositions
+                # not started yet, instead of waiting for all of them. The
+                # ones already saved are kept for the next run. 
+                executor.shutdown(wait=False, cancel_futures=True)
+                cache.close()
+                raise
+
+        propositions = pd.read_sql("SELECT * FROM propositions", cache, index_col='id')
+        cache.close()
+
+        propositions = propositions.reindex([p for p in ids if p in propositions.index])
+        propositions['codTema'] = propositions['codTema'].apply(json.loads)
+        propositions['Tema'] = propositions['Tema'].apply(json.loads)
+        propositions.reset_index().to_csv(os.path.join(self.data_root, "tables/propositions.csv"), index=False) 
+
+        if failures > 0: 
+            print("WARNING - {} propositions failed. Run again to fetch them.".format(failures))
 
         print("MESSAGE - Proposition file is done!")
 
+    def fetch_proposition(self, proposition, bucket, max_retries = 8) -> tuple: 
+        """
+        Fetch the type and the topics of a proposition. Unknown propositions
+        have None as type and topics. After a failure, it waits an
+        exponentially increasing time (with jitter) before trying again. 
+        - proposition (int): proposition id. 
+        - bucket (TokenBucket): rate limiter shared by the workers. 
+        - max_retries (int): number of attempts before raising an exception. 
+        """
+        from DadosAbertosBrasil import camara
+
+        for attempt in range(max_retries): 
+            try: 
+                bucket.acquire()
+                prop = camara.Proposicao(cod=proposition)
+                bucket.acquire()
+                tema = prop.temas()
+            except KeyError: 
+                return proposition, None, None, None
+            except Exception: 
+                time.sleep(min(60, 2**attempt)*(0.5 + random.random()/2))
+                continue
+
+            if tema.shape[0] > 0: 
+                return proposition, prop.tipo_sigla, list(tema.codTema), list(tema.tema)
+            else: 
+                return proposition, prop.tipo_sigla, None, None
+
+        raise Exception("ERROR - The proposition {} could not be fetched.".format(proposition))
+
+    @stage()
     def get_fronts(self, verify=True) -> None: 
         """
         This function downloads all the parliamentary fronts and their
         members. It saves as a csv table in the end. It gets data from the
         legislature 54. Before that, membership information was unavailable. 
+        - verify (bool): skip when the table was already generated (see
+          `ResultCache`). 
         """
 
         print("MESSAGE - Starting to download and prepare the fronts file.")
 
+        key = self.cache.key()
         if verify: 
-            if os.path.exists('../data/tables/fronts.csv'): 
+            if self.cache.fresh('fronts', key): 
                 print('MESSAGE - The file already exists.')
                 return
 
         page = requests.get(self.archive_website+"frentesDeputados/csv/frentesDeputados.csv")
-        with open('../data/raw/fronts.csv', 'w') as f: 
+        with open(os.path.join(self.data_root, 'raw/fronts.csv'), 'w') as f: 
             f.write(page.text)
 
         print('MESSAGE - The file was downloaded! Saving...')
 
         info_needed = ['id', 'titulo', 'deputado_.id', 'deputado_.idLegislatura','deputado_.titulo']
-        fronts = pd.read_csv('../data/raw/fronts.csv', sep=';', encoding='latin-1')[info_needed]
+        fronts = pd.read_csv(os.path.join(self.data_root, 'raw/fronts.csv'), sep=';', encoding='latin-1')[info_needed]
         
         fronts['deputado_.id'].fillna(0, inplace=True)
         fronts['deputado_.id'] = fronts['deputado_.id'].astype(int)  
@@ -286,27 +526,25 @@ class DataPreprocessing:
                                         'deputado_.idLegislatura': 'legislatura', 
                                         'deputado_.titulo': 'coordenador'})
 
-        fronts.to_csv('../data/tables/fronts.csv')
+        fronts.to_csv(os.path.join(self.data_root, 'tables/fronts.csv'))
+        self.cache.store('fronts', key, [os.path.join(self.data_root, 'tables/fronts.csv')])
 
         print('MESSAGE - Parliamentary fronts file done!')
 
+    @stage()
     def incidence_matrix(self, verify = True, yearly = False) -> None: 
         """
         This function creates the incidence matrix, where the rows are the
         votes and the columns are the deputies. Each legislature is saved in a
-        different file. 
+        different binary file (see `matrix_storage`), with the votes coded
+        according to the vote mapping. 
+        - verify (bool): skip when the matrices were already built from the
+          same voting tables and vote mapping (see `ResultCache`). 
+        - yearly (bool): build the matrices of each year too. 
         """
 
         print("MESSAGE - Starting to build the incidence matrices.")
 
-        if verify:
-            for legislature in range(52,57): 
-                if not os.path.exists('../data/tables/incidence_matrix_{}.csv'.format(legislature)): 
-                    break
-            else: 
-                print('MESSAGE - The file already exists.')
-                return
-
         vote_mapping = {"Não": -1, 
                 "Sim": 1, 
                 "Abstenção": 0, 
@@ -315,72 +553,185 @@ class DataPreprocessing:
                 "Branco": 255, 
                 "Obstrução": 0.1, 
                 "Favorável com restrições": 0.5}
-        with open("../data/tables/vote_mapping.json", 'w') as f: 
+
+        key = self.incidence_key(vote_mapping, yearly)
+        if verify:
+            if self.cache.fresh('incidence_matrix', key): 
+                print('MESSAGE - The file already exists.')
+                return
+
+        with open(os.path.join(self.data_root, "tables/vote_mapping.json"), 'w') as f: 
             json.dump(vote_mapping, f)
 
-        votes = pd.read_csv('../data/tables/votes_info.csv', encoding='latin-1')
-        votes_deputies = pd.read_csv('../data/tables/votes_deputies.csv', encoding='latin-1')
-        votes_deputies["voto"] = votes_deputies["voto"].replace(vote_mapping)
+        votes = pd.read_csv(os.path.join(self.data_root, 'tables/votes_info.csv'), encoding='latin-1')
+        votes_deputies = pd.read_csv(os.path.join(self.data_root, 'tables/votes_deputies.csv'), encoding='latin-1')
+        votes_deputies["voto"] = self.map_votes(votes_deputies["voto"], vote_mapping)
+        record(rows_in=votes_deputies.shape[0])
         votes_info = pd.merge(left=votes_deputies, right=votes, left_on='idVotacao', right_on='id').drop(columns='id')
         
         del votes, votes_deputies
 
-        for legislature in trange(52,57, position=0, desc='Legislature'): 
-            
-            votes = votes_info[votes_info.legislature==legislature]
-            unique_votes = votes.idVotacao.unique()
-            unique_deputies = votes.deputado_id.unique()
-            
-            incidence_matrix = pd.DataFrame(index = unique_votes, columns = unique_deputies)
+        legislatures = votes_info.groupby('legislature')
+        codebook = sorted(set(vote_mapping.values()))
+        outputs = [os.path.join(self.data_root, "tables/vote_mapping.json")]
 
-            for deputy in tqdm(unique_deputies, position=1,leave=True, desc='Deputies'): 
+        for legislature in trange(52,57, position=0, desc='Legislature'): 
 
-                filter_dep = votes[votes.deputado_id == deputy]
-                incidence_matrix.loc[filter_dep.idVotacao, deputy] = filter_dep.voto.values
-                
-            incidence_matrix.to_csv("../data/tables/incidence_matrix_{}.csv".format(legislature))
+            if legislature in legislatures.groups: 
+                votes = legislatures.get_group(legislature)
+            else: 
+                votes = votes_info.iloc[:0]
+
+            incidence_matrix = self.pivot_votes(votes)
+            metadata = {'legislature': legislature, 'vote_mapping': vote_mapping}
+            save_matrix(incidence_matrix, os.path.join(self.data_root, "tables/incidence_matrix_{}".format(legislature)), 
+                        metadata=metadata, codebook=codebook)
+            outputs.append(os.path.join(self.data_root, "tables/incidence_matrix_{}".format(legislature)))
+            record(rows_out=incidence_matrix.shape[0])
             
             if yearly == True: 
 
-                years = votes.year.unique()
-
-                for y in years: 
-                    votes_yearly = votes[votes.year == y]
-                    unique_votes = votes_yearly.idVotacao.unique()
-                    unique_deputies = votes_yearly.deputado_id.unique()
-            
-                    incidence_matrix = pd.DataFrame(index = unique_votes, columns = unique_deputies)
-
-                    for deputy in unique_deputies: 
+                for y, votes_yearly in votes.groupby('year', sort=False): 
+                    incidence_matrix = self.pivot_votes(votes_yearly)
+                    save_matrix(incidence_matrix, os.path.join(self.data_root, "tables/incidence_matrix_{}_year_{}".format(legislature, y)), 
+                                metadata=dict(metadata, year=int(y)), codebook=codebook)
+                    outputs.append(os.path.join(self.data_root, "tables/incidence_matrix_{}_year_{}".format(legislature, y)))
 
-                        filter_dep = votes_yearly[votes_yearly.deputado_id == deputy]
-                        incidence_matrix.loc[filter_dep.idVotacao, deputy] = filter_dep.voto.values
-                
-                    incidence_matrix.to_csv("../data/tables/incidence_matrix_{}_year_{}.csv".format(legislature, y))
+        self.store_incidence(key, outputs, yearly)
             
         print("\n")                
         print("MESSAGE - The incidence matrices are done!")
 
-if __name__ == '__main__': 
+    def incidence_key(self, vote_mapping, yearly) -> str: 
+        """
+        Cache key of the incidence matrices: the voting tables, the vote
+        mapping and whether there are yearly matrices. 
+        """
+        return self.cache.key([os.path.join(self.data_root, 'tables/votes_info.csv'), os.path.join(self.data_root, 'tables/votes_deputies.csv')], 
+                              {'vote_mapping': vote_mapping, 'yearly': yearly})
 
-    preprocessing = DataPreprocessing()
-    preprocessing.download_necessary_files()
+    def store_incidence(self, key, outputs, yearly) -> None: 
+        """
+        Save the key of the incidence matrices in the cache. The matrices
+        (paths without extension) are saved with both of their files. 
+        """
+        files = [path for path in outputs if path.endswith('.json')] 
+        files += [path + extension for path in outputs if not path.endswith('.json') for extension in ['.npy', '.npz']]
+        self.cache.store('incidence_matrix', key, files, {'yearly': yearly})
 
-    preprocessing.get_deputies()
+    @stage()
+    def update_votes(self, year, yearly = True) -> list: 
+        """
+        Incremental update for a year with new votings. The raw files of the
+        year are ingested again (see `ingest_year`) and only the votings not
+        yet in `votes_info.csv` are appended to the voting tables and to the
+        saved incidence matrices. It returns the ids of the new votings, which
+        can be passed to `GraphConstruction.update_legislature`. 
+        - year: MMMM of the raw files with new votings. 
+        - yearly (bool): update the yearly incidence matrices too (the ones
+          of new years are created). 
+        """
+        print("MESSAGE - Looking for new votings in {}.".format(year))
 
-    preprocessing.prepare_votes_table()
+        self.ingest_year(year)
 
-    preprocessing.get_fronts()
+        known = pd.read_csv(os.path.join(self.data_root, 'tables/votes_info.csv'), usecols=['id'], dtype={'id': str}, encoding='latin-1').id
+        votes = pd.read_csv(os.path.join(self.data_root, 'tables/votes/votes_info-{}.csv'.format(year)), dtype={'id': str}, encoding='latin-1')
+        votes = votes[~votes.id.isin(known)]
+
+        if votes.shape[0] == 0: 
+            print("MESSAGE - There are no new votings.")
+            return []
+
+        votes_deputies = pd.read_csv(os.path.join(self.data_root, 'tables/votes/votes_deputies-{}.csv'.format(year)), dtype={'idVotacao': str}, 
+                                     encoding='latin-1')
+        votes_deputies = votes_deputies[votes_deputies.idVotacao.isin(votes.id)]
+
+        votes.to_csv(os.path.join(self.data_root, 'tables/votes_info.csv'), mode='a', header=False, index=False, encoding='latin-1')
+        votes_deputies.to_csv(os.path.join(self.data_root, 'tables/votes_deputies.csv'), mode='a', header=False, index=False, encoding='latin-1')
+
+        with open(os.path.join(self.data_root, "tables/vote_mapping.json")) as f: 
+            vote_mapping = json.load(f)
+        codebook = sorted(set(vote_mapping.values()))
+
+        votes_deputies["voto"] = self.map_votes(votes_deputies["voto"], vote_mapping)
+        record(rows_in=votes_deputies.shape[0])
+        votes_info = pd.merge(left=votes_deputies, right=votes, left_on='idVotacao', right_on='id').drop(columns='id')
+
+        paths = {legislature: os.path.join(self.data_root, "tables/incidence_matrix_{}".format(legislature)) 
+                 for legislature in votes_info.legislature.unique()}
+        if yearly: 
+            paths.update({(legislature, y): os.path.join(self.data_root, "tables/incidence_matrix_{}_year_{}".format(legislature, y)) 
+                          for legislature, y in votes_info[['legislature', 'year']].drop_duplicates().itertuples(index=False)})
+
+        for key, path in paths.items(): 
+            if isinstance(key, tuple): 
+                new_votes = votes_info[(votes_info.legislature == key[0])&(votes_info.year == key[1])]
+                metadata = {'legislature': int(key[0]), 'vote_mapping': vote_mapping, 'year': int(key[1])}
+            else: 
+                new_votes = votes_info[votes_info.legislature == key]
+                metadata = {'legislature': int(key), 'vote_mapping': vote_mapping}
+
+            # The matrix of a year without votings yet is created. 
+            new_matrix = self.pivot_votes(new_votes)
+            if matrix_exists(path): 
+                new_matrix = pd.concat([load_matrix(path, mmap=False), new_matrix])
+            save_matrix(new_matrix, path, metadata=metadata, codebook=codebook)
+
+        # The updated files are as fresh as a full rebuild, so their keys
+        # are saved again. 
+        parameters = self.cache.parameters('votes_tables')
+        if parameters is not None: 
+            self.cache.store('votes_tables', self.votes_tables_key(*parameters['years']), 
+                             [os.path.join(self.data_root, 'tables/votes_info.csv'), os.path.join(self.data_root, 'tables/votes_deputies.csv')], parameters)
+        parameters = self.cache.parameters('incidence_matrix')
+        if parameters is not None: 
+            outputs = self.cache.outputs('incidence_matrix')
+            outputs += [path + extension for key, path in paths.items() if matrix_exists(path) 
+                        for extension in ['.npy', '.npz'] if path + extension not in outputs]
+            self.cache.store('incidence_matrix', self.incidence_key(vote_mapping, parameters['yearly']), outputs, parameters)
+
+        print("MESSAGE - {} new votings were added.".format(votes.shape[0]))
+
+        return list(votes.id)
+
+    def map_votes(self, votes, vote_mapping) -> pd.Series: 
+        """
+        Map the vote labels to numbers. A label that is not in the vote
+        mapping (for instance, read with the wrong encoding) raises an
+        exception instead of becoming a missing vote. 
+        - votes (Series): vote labels. 
+        - vote_mapping (dict): label -> number. 
+        """
+        mapped = votes.map(vote_mapping)
+        unknown = mapped.isna() & votes.notna()
+        if unknown.any(): 
+            raise Exception('The votes {} are not in the vote mapping'.format(sorted(set(votes[unknown].astype(str)))))
+        return mapped
+
+    def pivot_votes(self, votes) -> pd.DataFrame: 
+        """
+        Build the incidence matrix of a table of votes in a single pass. The
+        votings and the deputies are factorized into integer codes (keeping
+        the order they appear) and the votes are scattered into a float array.
+        Missing votes are NaN. 
+        - votes (DataFrame): table with columns idVotacao, deputado_id and
+          voto (already mapped to numbers). 
+        """
+        votings, unique_votes = pd.factorize(votes.idVotacao)
+        deputies, unique_deputies = pd.factorize(votes.deputado_id)
+
+        incidence_matrix = np.full((len(unique_votes), len(unique_deputies)), np.nan)
+        incidence_matrix[votings, deputies] = votes.voto.to_numpy(dtype=float)
+
+        return pd.DataFrame(incidence_matrix, index=unique_votes, columns=unique_deputies)
+
+if __name__ == '__main__': 
 
-    preprocessing.incidence_matrix(verify=True, yearly=True)
+    import sys
+    from pipeline import main
 
-    print("Do you want to download the propositions? It takes 20min - 30min and it is in development.")
-    while True: 
-        ans = input("[y/n]")
-        if ans == 'y': 
-            preprocessing.get_propositions()
-            break
-        elif ans == 'n':
-            break
-        else: 
-            continue
\ No newline at end of file
+    # The propositions take 20min - 30min, so they are only fetched with
+    # `python pipeline.py --stages propositions`. The options of `pipeline.py`
+    # (such as --data-root and --force) can be given too. 
+    sys.exit(main(['--stages', 'downloads', 'deputies', 'votes', 'fronts', 'incidence'] + sys.argv[1:]))
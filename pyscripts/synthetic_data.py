@@ -0,0 +1,250 @@
+#!/usr/bin/python
+
+import pandas as pd
+import numpy as np
+import os
+
+from tqdm import trange
+
+class SyntheticChamber:
+    """
+    Generator of synthetic raw voting files with the schemas of the open data
+    of the Câmara dos Deputados (`votacoes-{year}.csv` and
+    `votacoesVotos-{year}.csv`, latin-1 encoded and separated by `;`), so the
+    pipeline can be run and measured without the API. The parties belong to
+    blocs: in each voting every bloc has a position, each party follows its
+    bloc most of the times and each deputy follows its party with the given
+    cohesion.
+    """
+
+    votings_columns = ['id', 'uri', 'data', 'dataHoraRegistro', 'siglaOrgao', 'uriOrgao', 'uriEvento',
+                       'proposicaoObjeto', 'uriProposicaoObjeto', 'descricao', 'aprovacao', 'votosSim',
+                       'votosNao', 'votosOutros', 'ultimaAberturaVotacao_dataHoraRegistro',
+                       'ultimaAberturaVotacao_descricao', 'ultimaApresentacaoProposicao_dataHoraRegistro',
+                       'ultimaApresentacaoProposicao_descricao', 'ultimaApresentacaoProposicao_idProposicao',
+                       'ultimaApresentacaoProposicao_uriProposicao']
+
+    votes_columns = ['idVotacao', 'uriVotacao', 'dataHoraVoto', 'voto', 'deputado_id', 'deputado_uri',
+                     'deputado_nome', 'deputado_siglaPartido', 'deputado_uriPartido', 'deputado_siglaUf',
+                     'deputado_idLegislatura', 'deputado_urlFoto']
+
+    regions = {'RR': 'Norte', 'AP': 'Norte', 'AM': 'Norte', 'PA': 'Norte', 'AC': 'Norte',
+               'RO': 'Norte', 'TO': 'Norte', 'MA': 'Nordeste', 'PI': 'Nordeste', 'CE': 'Nordeste',
+               'RN': 'Nordeste', 'PB': 'Nordeste', 'PE': 'Nordeste', 'AL': 'Nordeste', 'SE': 'Nordeste',
+               'BA': 'Nordeste', 'MT': 'Centro-oeste', 'DF': 'Centro-oeste', 'GO': 'Centro-oeste',
+               'MS': 'Centro-oeste', 'MG': 'Sudeste', 'ES': 'Sudeste', 'RJ': 'Sudeste',
+               'SP': 'Sudeste', 'PR': 'Sul', 'SC': 'Sul', 'RS': 'Sul'}
+
+    api = 'https://dadosabertos.camara.leg.br/api/v2/'
+
+    def __init__(self, deputies = 513, parties = 20, blocs = 2, votings_per_year = 400, nominal = 0.7,
+                 party_discipline = 0.9, cohesion = 0.85, absence = 0.1, abstention = 0.02,
+                 obstruction = 0.02, other = 0.005, renewal = 0.5, seed = 0) -> None:
+        """
+        - deputies (int): number of deputies of each legislature.
+        - parties (int): number of parties. Their sizes decay as in the real
+          chamber (a few large parties and many small ones).
+        - blocs (int): number of voting blocs the parties are split into.
+        - votings_per_year (int): number of votings of each year.
+        - nominal (float): fraction of the votings with nominal votes (the
+          other ones are not in `votacoesVotos`).
+        - party_discipline (float): probability of a party to vote with its
+          bloc.
+        - cohesion (float): probability of a deputy to vote with its party.
+        - absence (float): probability of a deputy to be absent (no row).
+        - abstention, obstruction, other (float): probabilities of
+          'Abstenção', 'Obstrução' and of the other votes ('Artigo 17' and
+          secret votes).
+        - renewal (float): fraction of new deputies in each legislature.
+        - seed (int): seed of the generator.
+        """
+        self.deputies = deputies
+        self.parties = parties
+        self.blocs = blocs
+        self.votings_per_year = votings_per_year
+        self.nominal = nominal
+        self.party_discipline = party_discipline
+        self.cohesion = cohesion
+        self.absence = absence
+        self.abstention = abstention
+        self.obstruction = obstruction
+        self.other = other
+        self.renewal = renewal
+        self.seed = seed
+
+        rng = np.random.default_rng(seed)
+        self.party_names = np.array(['P{:02d}'.format(i) for i in range(parties)])
+        self.party_bloc = rng.integers(0, blocs, parties)
+        sizes = 1/np.arange(1, parties + 1)
+        self.party_sizes = sizes/sizes.sum()
+        self.rosters = {}
+
+    def legislature(self, year, month) -> np.ndarray:
+        """
+        Legislature of the dates, as in `DataPreprocessing.ingest_year`.
+        """
+        year_shift = np.asarray(year) - 2003
+        return year_shift//4 + 52 - ((np.asarray(month) == 1)&(year_shift%4 == 0))
+
+    def roster(self, legislature) -> pd.DataFrame:
+        """
+        Deputies of a legislature, with the columns of
+        `DataPreprocessing.get_deputies`. A fraction `renewal` of them is new,
+        the others come from the previous legislature (and may change party).
+        """
+        if legislature in self.rosters:
+            return self.rosters[legislature]
+
+        rng = np.random.default_rng([self.seed, legislature])
+
+        if legislature - 1 in self.rosters:
+            previous = self.rosters[legislature - 1]
+            kept = previous.sample(n = int(round((1 - self.renewal)*self.deputies)), random_state = rng)
+            start = max(roster.id.max() for roster in self.rosters.values()) + 1
+        else:
+            kept = pd.DataFrame(columns = ['id', 'nome', 'siglaPartido', 'siglaUf'])
+            start = 100000 + 10000*(legislature - 52)*(self.deputies//10000 + 1)
+
+        new = self.deputies - kept.shape[0]
+        ids = np.arange(start, start + new)
+        new = pd.DataFrame({'id': ids,
+                            'nome': ['Deputado {}'.format(i) for i in ids],
+                            'siglaPartido': rng.choice(self.party_names, new, p = self.party_sizes),
+                            'siglaUf': rng.choice(list(self.regions), new)})
+
+        kept = kept[['id', 'nome', 'siglaPartido', 'siglaUf']].copy()
+        switch = rng.random(kept.shape[0]) < 0.1
+        kept.loc[switch, 'siglaPartido'] = rng.choice(self.party_names, switch.sum(), p = self.party_sizes)
+
+        roster = pd.concat([kept, new], ignore_index = True)
+        roster['id'] = roster.id.astype(int)
+        roster['uri'] = self.api + 'deputados/' + roster.id.astype(str)
+        roster['idLegislatura'] = legislature
+        roster['region'] = roster.siglaUf.map(self.regions)
+
+        self.rosters[legislature] = roster[['id', 'uri', 'nome', 'siglaPartido', 'siglaUf', 'idLegislatura', 'region']]
+        return self.rosters[legislature]
+
+    def votings(self, year) -> pd.DataFrame:
+        """
+        Table `votacoes-{year}.csv` of a year. The dates are spread over the
+        year and the ids have the form `{proposition}-{number}`.
+        """
+        rng = np.random.default_rng([self.seed, year, 0])
+        n = self.votings_per_year
+
+        days = np.sort(rng.integers(0, 365, n))
+        dates = pd.Timestamp('{}-01-01'.format(year)) + pd.to_timedelta(days, unit = 'D')
+        hours = pd.to_timedelta(rng.integers(9*3600, 23*3600, n), unit = 's')
+        propositions = rng.integers(1000000, 2400000, n)
+        ids = ['{}-{}'.format(proposition, i) for i, proposition in zip(range(n), propositions)]
+
+        votes_yes = rng.integers(0, self.deputies, n)
+        votes_no = rng.integers(0, self.deputies - votes_yes + 1)
+
+        votings = pd.DataFrame({'id': ids,
+                                'uri': [self.api + 'votacoes/' + i for i in ids],
+                                'data': dates.strftime('%Y-%m-%d'),
+                                'dataHoraRegistro': (dates + hours).strftime('%Y-%m-%dT%H:%M:%S'),
+                                'siglaOrgao': rng.choice(['PLEN', 'CCJC', 'CFT', 'CE'], n, p = [0.7, 0.1, 0.1, 0.1]),
+                                'uriOrgao': self.api + 'orgaos/180',
+                                'uriEvento': self.api + 'eventos/' + pd.Series(rng.integers(50000, 70000, n)).astype(str),
+                                'proposicaoObjeto': '',
+                                'uriProposicaoObjeto': '',
+                                'descricao': 'Aprovado o requerimento.',
+                                'aprovacao': rng.integers(0, 2, n),
+                                'votosSim': votes_yes,
+                                'votosNao': votes_no,
+                                'votosOutros': rng.integers(0, 10, n),
+                                'ultimaAberturaVotacao_dataHoraRegistro': (dates + hours).strftime('%Y-%m-%dT%H:%M:%S'),
+                                'ultimaAberturaVotacao_descricao': 'Votação nominal.',
+                                'ultimaApresentacaoProposicao_dataHoraRegistro': dates.strftime('%Y-%m-%dT%H:%M:%S'),
+                                'ultimaApresentacaoProposicao_descricao': 'Requerimento',
+                                'ultimaApresentacaoProposicao_idProposicao': propositions,
+                                'ultimaApresentacaoProposicao_uriProposicao': [self.api + 'proposicoes/{}'.format(p) for p in propositions]})
+
+        return votings[self.votings_columns]
+
+    def votes(self, votings, year) -> pd.DataFrame:
+        """
+        Table `votacoesVotos-{year}.csv` with the votes of the nominal
+        votings of a year.
+        """
+        rng = np.random.default_rng([self.seed, year, 1])
+        votings = votings[rng.random(votings.shape[0]) < self.nominal]
+        dates = pd.to_datetime(votings.data)
+
+        tables = []
+        for legislature, votings_legislature in votings.groupby(self.legislature(dates.dt.year, dates.dt.month)):
+            roster = self.roster(int(legislature))
+            party = pd.Index(self.party_names).get_indexer(roster.siglaPartido)
+            v, d = votings_legislature.shape[0], roster.shape[0]
+
+            # Position of each bloc, line of each party and vote of each deputy.
+            bloc_position = rng.choice([-1, 1], (v, self.blocs))
+            party_line = bloc_position[:, self.party_bloc]
+            party_line = np.where(rng.random(party_line.shape) < self.party_discipline, party_line, -party_line)
+            line = party_line[:, party]
+            vote = np.where(rng.random((v, d)) < self.cohesion, line, rng.choice([-1, 1], (v, d)))
+
+            labels = np.where(vote == 1, 'Sim', 'Não').astype(object)
+            draw = rng.random((v, d))
+            labels[draw < self.abstention + self.obstruction + self.other] = 'Obstrução'
+            labels[draw < self.abstention + self.other] = 'Abstenção'
+            labels[draw < self.other] = 'Artigo 17'
+            labels[draw < self.other/2] = ''
+            present = rng.random((v, d)) >= self.absence
+
+            rows, cols = np.nonzero(present)
+            deputies = roster.iloc[cols]
+            tables.append(pd.DataFrame({'idVotacao': votings_legislature.id.to_numpy()[rows],
+                                        'uriVotacao': votings_legislature.uri.to_numpy()[rows],
+                                        'dataHoraVoto': votings_legislature.dataHoraRegistro.to_numpy()[rows],
+                                        'voto': labels[rows, cols],
+                                        'deputado_id': deputies.id.to_numpy(),
+                                        'deputado_uri': deputies.uri.to_numpy(),
+                                        'deputado_nome': deputies.nome.to_numpy(),
+                                        'deputado_siglaPartido': deputies.siglaPartido.to_numpy(),
+                                        'deputado_uriPartido': self.api + 'partidos/' + deputies.siglaPartido.to_numpy(),
+                                        'deputado_siglaUf': deputies.siglaUf.to_numpy(),
+                                        'deputado_idLegislatura': deputies.idLegislatura.to_numpy(),
+                                        'deputado_urlFoto': 'https://www.camara.leg.br/internet/deputado/bandep/'
+                                                            + deputies.id.astype(str).to_numpy() + '.jpg'}))
+
+        if len(tables) == 0:
+            return pd.DataFrame(columns = self.votes_columns)
+        return pd.concat(tables, ignore_index = True)[self.votes_columns]
+
+    def write(self, year1 = 2019, year2 = 2021, deputies_table = True, data_root = '../data') -> None:
+        """
+        Write the raw files of the years in `raw/` of the data folder, as
+        `DataPreprocessing.download_necessary_files` does, and the deputies of
+        their legislatures in `tables/deputies.csv`, as
+        `DataPreprocessing.get_deputies` does.
+        - year1, year2 (int): first and last years.
+        - deputies_table (bool): write the deputies table too.
+        - data_root (str): folder of the data (see `DataPreprocessing`).
+        """
+        for folder in [data_root, os.path.join(data_root, 'raw'), os.path.join(data_root, 'tables')]:
+            if not os.path.exists(folder):
+                os.mkdir(folder)
+
+        for year in trange(year1, year2 + 1, desc = 'Year'):
+            votings = self.votings(year)
+            votes = self.votes(votings, year)
+            votings.to_csv(os.path.join(data_root, 'raw/votacoes-{}.csv'.format(year)), sep = ';', encoding = 'latin-1', index = False)
+            votes.to_csv(os.path.join(data_root, 'raw/votacoesVotos-{}.csv'.format(year)), sep = ';', encoding = 'latin-1', index = False)
+
+        if deputies_table:
+            legislatures = range(int(self.legislature(year1, 1)), int(self.legislature(year2, 12)) + 1)
+            deputies = pd.concat([self.roster(legislature) for legislature in legislatures], ignore_index = True)
+            deputies.to_csv(os.path.join(data_root, 'tables/deputies.csv'))
+
+if __name__ == '__main__':
+
+    print("INFO - You can change the size of the synthetic chamber in the script file!")
+
+    chamber = SyntheticChamber(deputies = 513, parties = 20, blocs = 2, votings_per_year = 400)
+    chamber.write(2019, 2021)
+
+    print("MESSAGE - The synthetic raw files were written!")
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+from typing import TYPE_CHECKING
+
+from matrix_storage import SparseMatrix
+
+if TYPE_CHECKING:
+    import networkx as nx
+
+class ThresholdSweep:
+    """
+    Index of the links of an adjacency matrix sorted by weight. The graph
+    with the links above a threshold (as in
+    `GraphConstruction.build_graph_threshold`) is a prefix of this list, so
+    it is found by binary search instead of comparing the whole matrix.
+    """
+
+    def __init__(self, adjacency_matrix) -> None:
+        """
+        Build the index from the upper triangle (with the diagonal) of the
+        adjacency matrix.
+        - adjacency_matrix (DataFrame or SparseMatrix): symmetric matrix of
+          weights. A `SparseMatrix` only gives the graphs above its
+          `exact_above`.
+        """
+        self.nodes = adjacency_matrix.columns
+
+        if isinstance(adjacency_matrix, SparseMatrix):
+            upper = sp.triu(adjacency_matrix.csr).tocoo()
+            rows, cols, weights = upper.row, upper.col, upper.data.astype(float)
+            self.exact_above = adjacency_matrix.exact_above
+        else:
+            weights = adjacency_matrix.to_numpy(dtype = float)
+            rows, cols = np.triu_indices(weights.shape[0])
+            weights = weights[rows, cols]
+            self.exact_above = -np.inf
+
+        order = np.argsort(-weights, kind = 'stable')
+        self.rows = rows[order]
+        self.cols = cols[order]
+        self.weights = weights[order]
+
+    def number_of_edges(self, threshold) -> int:
+        """
+        Number of links with weight strictly greater than the threshold.
+        """
+        if threshold < self.exact_above:
+            raise Exception('The sparse matrix only has the links above {}.'.format(self.exact_above))
+        return int(np.searchsorted(-self.weights, -threshold, side = 'left'))
+
+    def edges(self, threshold) -> tuple:
+        """
+        Rows and columns (positions in the adjacency matrix) of the links
+        with weight greater than the threshold.
+        """
+        k = self.number_of_edges(threshold)
+        return self.rows[:k], self.cols[:k]
+
+    def degrees(self, threshold) -> pd.Series:
+        """
+        Degree of each deputy at the threshold. Self-loops count twice, as in
+        networkx.
+        """
+        rows, cols = self.edges(threshold)
+        n = len(self.nodes)
+        degrees = np.bincount(rows, minlength = n) + np.bincount(cols, minlength = n)
+        return pd.Series(degrees, index = self.nodes)
+
+    def graph(self, threshold) -> 'nx.Graph':
+        """
+        Graph with all the deputies and the links with weight greater than
+        the threshold.
+        """
+        # networkx is only imported when a graph is built.
+        import networkx as nx
+
+        rows, cols = self.edges(threshold)
+        G = nx.Graph()
+        G.add_nodes_from(self.nodes)
+        G.add_edges_from(zip(self.nodes[rows], self.nodes[cols]), weight = 1)
+        return G
+
+    def sweep(self, thresholds) -> pd.DataFrame:
+        """
+        Number of links, zero-degree deputies and connected components for
+        each threshold. The thresholds are visited in decreasing order, adding
+        the new links to a union-find structure, so the whole sweep costs one
+        pass over the links.
+        - thresholds (list): thresholds to evaluate.
+        """
+        n = len(self.nodes)
+        parent = list(range(n))
+        degrees = [0]*n
+        components = n
+        zero_degree = n
+        k = 0
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        results = {}
+        for threshold in sorted(set(thresholds), reverse = True):
+            k_new = self.number_of_edges(threshold)
+            for i, j in zip(self.rows[k:k_new].tolist(), self.cols[k:k_new].tolist()):
+                zero_degree -= (degrees[i] == 0) + (i != j)*(degrees[j] == 0)
+                degrees[i] += 1
+                degrees[j] += 1
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j:
+                    parent[root_i] = root_j
+                    components -= 1
+            k = k_new
+            results[threshold] = (k, zero_degree, components)
+
+        results = pd.DataFrame.from_dict(results, orient = 'index',
+                                         columns = ['edges', 'zero_degree', 'components'])
+        results.index.name = 'threshold'
+        return results.sort_index()